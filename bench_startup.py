@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+
+# modules that only plotting and statistics should load
+heavy_modules = ['matplotlib', 'scipy', 'pandas', 'ephem']
+
+
+def run(code):
+    """Runs some python code in a fresh interpreter from this folder, returns the wall time and
+    the output.
+    """
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return time.perf_counter() - start, output
+
+
+parser = argparse.ArgumentParser(description="check that importing my_calendar stays fast")
+parser.add_argument("-r", "--repeats", type=int, default=7, help="number of runs, the fastest one counts")
+parser.add_argument("-l", "--limit", type=float, default=0.3,
+                    help="maximum time in seconds added by the import over an empty interpreter")
+args = parser.parse_args()
+
+bare = min(run('pass')[0] for _ in range(args.repeats))
+check = f"import sys, my_calendar; print(' '.join(m for m in {heavy_modules} if m in sys.modules))"
+runs = [run(check) for _ in range(args.repeats)]
+overhead = min(duration for duration, _ in runs) - bare
+loaded = runs[0][1].split()
+
+print(f"interpreter: {bare * 1000:.0f} ms, import my_calendar: +{overhead * 1000:.0f} ms (limit {args.limit * 1000:.0f} ms)")
+failed = False
+if loaded:
+    print("heavy modules loaded at import time:", ', '.join(loaded))
+    failed = True
+if overhead > args.limit:
+    print("import time over the limit")
+    failed = True
+sys.exit(1 if failed else 0)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import platform
+import contextlib
+import tempfile
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import my_calendar
+from my_calendar import Calendar
+from columns import ordinals_to_dates
+from storage import write_database
+from synthetic import generate
+
+
+def best_time(function, repeats, setup=None):
+    """Returns the fastest of several runs of function, calling setup before each of them
+    outside of the timing.
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def benchmark(database_path, repeats, num_queries=1000):
+    """Times the main operations of Calendar on the database in database_path. Returns a
+    dictionary of operation -> seconds.
+    """
+    my_calendar.path = database_path
+    results = {'load': best_time(Calendar, repeats)}
+    calendar = Calendar()
+    num_days = len(calendar.database)
+    rng = np.random.default_rng(0)
+    ordinals = calendar.columns.ordinals
+
+    results['dump'] = best_time(calendar.dump, repeats)
+    results['dump journal'] = best_time(lambda: calendar.dump(changed=[num_days - 1]), repeats)
+    calendar.dump()
+
+    query_dates = np.datetime_as_string(ordinals_to_dates(rng.integers(ordinals[0], ordinals[-1] + 1, num_queries)),
+                                        unit='D').tolist()
+    results[f'date_to_index x{num_queries}'] = best_time(
+        lambda: [calendar.date_to_index(query_date) for query_date in query_dates], repeats)
+    results[f'index_range x{num_queries}'] = best_time(
+        lambda: [calendar.index_range(30, query_date) for query_date in query_dates], repeats)
+
+    complex_fields = ['sat', 'fz', 'pain', 'pain.i', 'text:PAIN', 'text:headache.i', 'sharp', 'food:vino']
+    complex_fields = [field for field in complex_fields if field.split(':')[0].split('.')[0] in calendar.all_fields]
+    clear_cache = lambda: calendar.queries.invalidate(calendar.queries.version)
+    results['get_values'] = best_time(lambda: calendar.get_values(complex_fields, 0, num_days), repeats,
+                                      setup=clear_cache)
+    results['get_values cached'] = best_time(lambda: calendar.get_values(complex_fields, 0, num_days), repeats)
+
+    dates, values = calendar.read_values('sat', 0, num_days)
+    results['moving_average'] = best_time(lambda: calendar.moving_average(dates, values, 7), repeats)
+    results['lists_to_mat'] = best_time(lambda: calendar.lists_to_mat('food', 0, num_days, verbose=False), repeats)
+
+    def correlate():
+        # correlate prints the counts of the factors
+        with contextlib.redirect_stdout(io.StringIO()):
+            figure = calendar.correlate(argv=['food', 'sat', '-j', '1'], show=False)
+        plt.close(figure)
+    results['correlate'] = best_time(correlate, repeats)
+
+    def display():
+        headers = calendar.day_headers(ordinals)
+        return ''.join(calendar.format_day(day, header) for day, header in zip(calendar.database, headers))
+    results['display'] = best_time(display, repeats)
+    return results
+
+
+def compare(results, baseline, threshold, min_difference):
+    """Returns a list of descriptions of the operations that are slower than in the baseline by
+    more than a factor threshold and by more than min_difference seconds.
+    """
+    regressions = []
+    for size, operations in results.items():
+        for operation, duration in operations.items():
+            reference = baseline.get(size, {}).get(operation)
+            if reference is None:
+                continue
+            if duration > reference * threshold and duration - reference > min_difference:
+                regressions.append(f"{size} days, {operation}: {duration:.4f} s, baseline {reference:.4f} s "
+                                   f"({duration / reference:.2f}x)")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="time Calendar on synthetic databases")
+    parser.add_argument("-s", "--sizes", default='1000,10000,100000',
+                        help="numbers of days separated by commas (up to 1000000)")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="number of runs, the fastest one counts")
+    parser.add_argument("-f", "--format", choices=('json', 'bin'), default='json', help="database format")
+    parser.add_argument("-o", "--output", default='benchmark.json', help="file where the results are written")
+    parser.add_argument("-b", "--baseline", help="results of a previous run to compare with")
+    parser.add_argument("-t", "--threshold", type=float, default=1.25,
+                        help="slowdown factor over the baseline that counts as a regression")
+    parser.add_argument("-m", "--min-difference", type=float, default=0.005,
+                        help="slowdowns of less than this many seconds are ignored")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        # keep the keyword index and other cached files out of the user cache
+        os.environ['XDG_CACHE_HOME'] = directory
+        for num_days in map(int, args.sizes.split(',')):
+            database_path = os.path.join(directory, f'calendar_{num_days}.{args.format}')
+            write_database(database_path, generate(num_days))
+            results[str(num_days)] = benchmark(database_path, args.repeats)
+            for operation, duration in results[str(num_days)].items():
+                print(f"{num_days:>8} days  {operation:<22} {duration * 1000:10.2f} ms")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'results': results}, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_difference)
+        if regressions:
+            print("\nregressions:")
+            print('\n'.join(regressions))
+            sys.exit(1)
+        print("\nno regressions")
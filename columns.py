@@ -0,0 +1,283 @@
+import numpy as np
+from datetime import date
+
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+# how the value of a field is stored for each day
+ABSENT, FALSE, TRUE, INT, FLOAT, STR, OTHER = range(7)
+
+
+def encode_value(value):
+    """Returns the (kind, number, text) triplet used to store a value in columns. Values that
+    are neither bools, numbers that fit exactly in a float64, nor strings are of kind OTHER.
+    """
+    if value is True or value is False:
+        return (TRUE if value else FALSE), float(value), None
+    elif isinstance(value, int):
+        if abs(value) < 2 ** 53:
+            return INT, float(value), None
+        return OTHER, np.nan, None
+    elif isinstance(value, float):
+        return FLOAT, value, None
+    elif isinstance(value, str):
+        return STR, np.nan, value
+    return OTHER, np.nan, None
+
+
+def decode_value(kind, number, text):
+    """Inverse of encode_value for every kind except OTHER.
+    """
+    if kind == FALSE or kind == TRUE:
+        return kind == TRUE
+    elif kind == INT:
+        return int(number)
+    elif kind == FLOAT:
+        return float(number)
+    return text
+
+
+def parse_ordinals(date_strings):
+    """Parses a sequence of "%Y-%m-%d" strings into an int32 array of day ordinals.
+    """
+    days = np.array(date_strings, dtype='datetime64[D]').astype(np.int64)
+    return (days + EPOCH).astype(np.int32)
+
+
+def ordinals_to_dates(ordinals):
+    """Converts day ordinals into a datetime64[D] array.
+    """
+    return (np.asarray(ordinals, dtype=np.int64) - EPOCH).astype('datetime64[D]')
+
+
+def dates_to_ordinals(dates):
+    """Converts a datetime64 array (or anything numpy can cast to one) into day ordinals.
+    """
+    return np.asarray(dates, dtype='datetime64[D]').astype(np.int64) + EPOCH
+
+
+class TextColumn:
+    def __init__(self, texts):
+        """Stores the strings of one field in a single utf-8 pool. Entry i lives in
+        pool[offsets[i]:offsets[i+1]-1], each entry being followed by a null separator
+        so that searches never match across days. Missing entries are None in texts.
+        """
+        self.present = np.array([text is not None for text in texts], dtype=bool)
+        encoded = [b'' if text is None else text.encode('utf-8') for text in texts]
+        lengths = np.fromiter((len(e) + 1 for e in encoded), dtype=np.int64, count=len(encoded))
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.pool = b'\x00'.join(encoded) + b'\x00'
+
+    @classmethod
+    def from_pool(cls, pool, offsets, present):
+        """Wraps an existing pool, for example a memory-mapped file, without copying it.
+        """
+        column = cls.__new__(cls)
+        column.pool = pool
+        column.offsets = offsets
+        column.present = present
+        return column
+
+    def patched(self, changes, length):
+        """Returns a new column extended with missing entries up to length and with the entries
+        in changes (index -> text or None) replaced. The untouched parts of the pool are copied
+        in a few large slices.
+        """
+        lengths = np.ones(length, dtype=np.int64)
+        lengths[:len(self)] = np.diff(self.offsets)
+        present = np.zeros(length, dtype=bool)
+        present[:len(self)] = self.present
+        pool = bytes(self.pool[self.offsets[0]:self.offsets[-1]]) + b'\x00' * (length - len(self))
+        offsets = np.zeros(length + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        pieces = []
+        next_index = 0
+        for index in sorted(changes):
+            text = changes[index]
+            encoded = b'' if text is None else text.encode('utf-8')
+            pieces.append(pool[offsets[next_index]:offsets[index]])
+            pieces.append(encoded + b'\x00')
+            lengths[index] = len(encoded) + 1
+            present[index] = text is not None
+            next_index = index + 1
+        pieces.append(pool[offsets[next_index]:])
+
+        np.cumsum(lengths, out=offsets[1:])
+        return TextColumn.from_pool(b''.join(pieces), offsets, present)
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, index):
+        if not self.present[index]:
+            return None
+        return bytes(self.pool[self.offsets[index]:self.offsets[index + 1] - 1]).decode('utf-8')
+
+    def lengths(self):
+        """Returns the length in bytes of every entry.
+        """
+        return np.diff(self.offsets) - 1
+
+    def texts(self, first_index, last_index):
+        """Returns the strings of the days in the range that have this field.
+        """
+        indices = np.flatnonzero(self.present[first_index:last_index]) + first_index
+        return [bytes(self.pool[self.offsets[i]:self.offsets[i + 1] - 1]).decode('utf-8') for i in indices]
+
+    def contains(self, keyword, first_index, last_index):
+        """Returns a boolean array telling which days in the range contain the keyword.
+        """
+        found = np.zeros(last_index - first_index, dtype=bool)
+        start = self.offsets[first_index]
+        stop = self.offsets[last_index]
+        needle = keyword.encode('utf-8')
+        if not needle:
+            found[:] = self.present[first_index:last_index]
+            return found
+
+        positions = []
+        position = self.pool.find(needle, start, stop)
+        while position != -1:
+            positions.append(position)
+            # skip to the end of the day, one hit per day is enough
+            day = np.searchsorted(self.offsets, position, side='right') - 1
+            position = self.pool.find(needle, self.offsets[day + 1], stop)
+
+        if positions:
+            days = np.searchsorted(self.offsets, positions, side='right') - 1
+            found[days - first_index] = True
+        return found
+
+
+class Columns:
+    def __init__(self, database, fields, derived=None):
+        """Columnar view of the database. The day ordinals are parsed once, and the columns
+        of each field are built the first time they are requested:
+        numeric fields -> float64 array with NaN for missing days,
+        bool fields -> values array plus a mask of the days that have the field,
+        str fields -> TextColumn.
+        If the database was opened from a binary store, the columns are read from it
+        directly and only the days changed since it was written are encoded.
+        derived maps the names of numeric fields that are not stored in the database to
+        functions computing their values from an array of ordinals.
+        """
+        self.database = database
+        self.fields = fields
+        self.derived = derived or {}
+        self.store = getattr(database, 'store', None)
+        if self.store is None:
+            self.ordinals = parse_ordinals([day['date'] for day in database])
+        else:
+            self.ordinals = np.empty(len(database), dtype=np.int32)
+            self.ordinals[:self.store.num_days] = self.store.ordinals()
+            changes = database.changes
+            if changes:
+                indices = np.fromiter(changes, dtype=np.int64, count=len(changes))
+                self.ordinals[indices] = parse_ordinals([changes[index]['date'] for index in indices])
+        self._build_date_index()
+        self._encoded = {}
+        self._flags = {}
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def _build_date_index(self):
+        """Builds a table with one entry per calendar day between the first and the last
+        ordinal, holding the index of the first database entry on or after that day. The
+        database is expected to be sorted by date.
+        """
+        if len(self.ordinals) == 0:
+            self.first_ordinal = 0
+            self._dense = np.zeros(1, dtype=np.int32)
+            return
+        self.first_ordinal = int(self.ordinals[0])
+        span = int(self.ordinals[-1]) - self.first_ordinal + 1
+        days = np.arange(self.first_ordinal, self.first_ordinal + span, dtype=np.int32)
+        self._dense = np.searchsorted(self.ordinals, days, side='left').astype(np.int32)
+
+    def indices(self, ordinals):
+        """Maps an array of ordinals to the index of the first entry on or after each of
+        them, clipped to the valid range of indices.
+        """
+        offsets = np.clip(np.asarray(ordinals, dtype=np.int64) - self.first_ordinal, 0, len(self._dense) - 1)
+        return np.minimum(self._dense[offsets], max(len(self.ordinals) - 1, 0))
+
+    def index(self, ordinal):
+        """Scalar version of indices.
+        """
+        return int(self.indices(ordinal))
+
+    def lookup(self, ordinals):
+        """Maps an array of ordinals to the index of the entry on that exact day, or -1 for
+        days that are not in the database.
+        """
+        indices = self.indices(ordinals)
+        if len(self.ordinals) == 0:
+            return np.full(indices.shape, -1)
+        return np.where(self.ordinals[indices] == ordinals, indices, -1)
+
+    def kind(self, field):
+        field_type = self.fields[field]['type']
+        if field_type is bool:
+            return 'bool'
+        elif field_type is str:
+            return 'str'
+        else:
+            return 'number'
+
+    def encoded(self, field):
+        """Returns the kinds, numbers and TextColumn of a field.
+        """
+        if field not in self._encoded and field in self.derived:
+            numbers = np.asarray(self.derived[field](self.ordinals), dtype=np.float64)
+            kinds = np.full(len(self), FLOAT, dtype=np.uint8)
+            self._encoded[field] = kinds, numbers, TextColumn([None] * len(self))
+        if field not in self._encoded:
+            if self.store is None:
+                changes = dict(enumerate(self.database))
+                kinds, numbers = np.zeros(0, dtype=np.uint8), np.zeros(0)
+                text = TextColumn([])
+            else:
+                changes = self.database.changes
+                kinds, numbers, text = self.store.column(field)
+
+            if changes:
+                length = len(self.database)
+                kinds = np.concatenate((kinds, np.zeros(length - len(kinds), dtype=np.uint8)))
+                numbers = np.concatenate((numbers, np.full(length - len(numbers), np.nan)))
+                texts = {}
+                for index, day in changes.items():
+                    kinds[index], numbers[index], texts[index] = encode_value(day.get(field))
+                    if field not in day:
+                        kinds[index] = ABSENT
+                text = text.patched(texts, length)
+            self._encoded[field] = kinds, numbers, text
+        return self._encoded[field]
+
+    def numbers(self, field):
+        """Returns the values of a numeric field, bools count as 0 and 1.
+        """
+        return self.encoded(field)[1]
+
+    def flags(self, field):
+        """Returns the truth value of a field in each day.
+        """
+        if field not in self._flags:
+            kinds, numbers, text = self.encoded(field)
+            numeric = (kinds == INT) | (kinds == FLOAT)
+            self._flags[field] = (kinds == TRUE) | (numeric & (numbers != 0)) | ((kinds == STR) & (text.lengths() > 0))
+        return self._flags[field]
+
+    def text(self, field):
+        return self.encoded(field)[2]
+
+    def present(self, field):
+        """Returns a mask of the days that have a value for the field. For numeric fields only
+        numbers count as values.
+        """
+        kinds, numbers, text = self.encoded(field)
+        if self.kind(field) == 'number':
+            return ~np.isnan(numbers)
+        return kinds != ABSENT
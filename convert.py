@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+import argparse
+from storage import Journal, read_database, write_database
+
+
+parser = argparse.ArgumentParser(description="convert the database between the JSON and the binary (.bin) formats")
+parser.add_argument("source", help="database to read")
+parser.add_argument("destination", help="database to write")
+args = parser.parse_args()
+
+# the latest days may only be in the journal of the source
+database = read_database(args.source)
+Journal(args.source + '.journal').replay(database)
+write_database(args.destination, database)
+# a journal left next to the destination belongs to the file that was replaced
+Journal(args.destination + '.journal').clear()
@@ -0,0 +1,216 @@
+import numpy as np
+
+
+def _centered_values(values):
+    """Splits a matrix of days x targets with NaN into the validity mask, the centered values
+    (0 where invalid), the number of valid days, the sum of squares of each column and
+    whether each column is constant over its valid days.
+    """
+    valid = ~np.isnan(values)
+    n = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y_mean = np.where(valid, values, 0).sum(axis=0) / n
+    y_centered = np.where(valid, values - y_mean, 0)
+    y_constant = ~(np.where(valid, values, -np.inf).max(axis=0) > np.where(valid, values, np.inf).min(axis=0))
+    return valid.astype(float), y_centered, n, (y_centered ** 2).sum(axis=0), y_constant
+
+
+def pearson_matrix(factors_mat, values):
+    """Pearson correlation between every column of a boolean matrix of days x factors and every
+    column of a matrix of days x targets, computed for all pairs at once. Each target column
+    only uses the days where it is not NaN. Returns the correlations and their two-sided
+    p-values as factors x targets matrices, NaN where either variable is constant.
+    """
+    from scipy.special import stdtr
+
+    x = np.asarray(factors_mat, dtype=float)
+    valid, y_centered, n, y_squares, y_constant = _centered_values(values)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_sums = x.T @ valid
+        x_constant = (x_sums == 0) | (x_sums == n)
+        x_squares = x_sums - x_sums ** 2 / n
+
+        corr = (x.T @ y_centered) / np.sqrt(x_squares * y_squares)
+        corr = np.clip(corr, -1, 1)
+        corr[x_constant | y_constant] = np.nan
+
+        df = n - 2
+        t = corr * np.sqrt(df / (1 - corr ** 2))
+        p = 2 * stdtr(df, -np.abs(t))
+        p = np.where(df > 0, p, 1.)
+        p[np.isnan(corr)] = np.nan
+
+    return corr, p
+
+
+_shared = {}
+
+
+def _init_worker(x, valid, y_centered, n, y_squares, y_constant, abs_corr):
+    _shared.update(x=x, valid=valid, y_centered=y_centered, n=n, y_squares=y_squares, y_constant=y_constant,
+                   abs_corr=abs_corr)
+
+
+def _permutation_chunk(seed, num_permutations):
+    """Correlates the factors with num_permutations random permutations of the days, all in
+    one matrix product. Returns how many times each cell reached its observed absolute
+    correlation, and the maximum absolute correlation of each permutation. As in
+    pearson_matrix, pairs where either variable is constant over the valid days of the
+    permutation count as uncorrelated.
+    """
+    x, valid, y_centered = _shared['x'], _shared['valid'], _shared['y_centered']
+    n, y_squares, y_constant = _shared['n'], _shared['y_squares'], _shared['y_constant']
+    abs_corr = _shared['abs_corr']
+    num_days, num_targets = y_centered.shape
+
+    rng = np.random.default_rng(seed)
+    permutations = np.argsort(rng.random((num_permutations, num_days)), axis=1)
+    # permuting the rows of the targets is equivalent to permuting the rows of the factors
+    valid_batch = valid[permutations].transpose(1, 0, 2).reshape(num_days, -1)
+    y_batch = y_centered[permutations].transpose(1, 0, 2).reshape(num_days, -1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_sums = (x.T @ valid_batch).reshape(-1, num_permutations, num_targets)
+        x_constant = (x_sums == 0) | (x_sums == n)
+        x_squares = x_sums - x_sums ** 2 / n
+        corr = (x.T @ y_batch).reshape(-1, num_permutations, num_targets) / np.sqrt(x_squares * y_squares)
+    # otherwise the float noise over a zero variance would give the largest correlations
+    corr = np.clip(corr, -1, 1)
+    corr[x_constant | y_constant] = 0
+    abs_perm = np.nan_to_num(np.abs(corr), nan=0.)
+
+    exceed = (abs_perm >= abs_corr[:, np.newaxis, :] - 1e-12).sum(axis=1)
+    maxima = abs_perm.max(axis=(0, 2))
+    return exceed, maxima
+
+
+def permutation_test(factors_mat, values, corr, num_permutations, seed=0, num_workers=1, chunk_size=50):
+    """Permutation test for the correlations returned by pearson_matrix. The days of the
+    factors are shuffled num_permutations times, in chunks of chunk_size permutations that are
+    each computed with one matrix product and optionally spread over num_workers processes.
+    Every chunk gets its own seed spawned from seed, so results do not depend on the number of
+    workers. Returns the uncorrected p-value of each cell and the p-values corrected for
+    multiple comparisons with the max-statistic method.
+    """
+    x = np.asarray(factors_mat, dtype=float)
+    valid, y_centered, n, y_squares, y_constant = _centered_values(values)
+    abs_corr = np.nan_to_num(np.abs(corr), nan=np.inf)
+    arrays = (x, valid, y_centered, n, y_squares, y_constant, abs_corr)
+
+    sizes = [min(chunk_size, num_permutations - start) for start in range(0, num_permutations, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    if num_workers > 1 and len(sizes) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=arrays) as executor:
+            results = list(executor.map(_permutation_chunk, seeds, sizes))
+    else:
+        _init_worker(*arrays)
+        results = [_permutation_chunk(chunk_seed, size) for chunk_seed, size in zip(seeds, sizes)]
+        _shared.clear()
+
+    exceed = sum(result[0] for result in results)
+    maxima = np.sort(np.concatenate([result[1] for result in results]))
+
+    p = (1 + exceed) / (1 + num_permutations)
+    exceed_max = num_permutations - np.searchsorted(maxima, abs_corr - 1e-12, side='left')
+    p_max = (1 + exceed_max) / (1 + num_permutations)
+    p[np.isnan(corr)] = np.nan
+    p_max[np.isnan(corr)] = np.nan
+    return p, p_max
+
+
+def fdr(p):
+    """Benjamini-Hochberg adjusted p-values, NaN entries are left out of the correction.
+    """
+    adjusted = np.full(p.shape, np.nan)
+    tested = ~np.isnan(p)
+    p_tested = p[tested]
+    order = np.argsort(p_tested)
+    ranked = p_tested[order] * len(p_tested) / np.arange(1, len(p_tested) + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    adjusted_tested = np.empty(len(p_tested))
+    adjusted_tested[order] = np.minimum(ranked, 1)
+    adjusted[tested] = adjusted_tested
+    return adjusted
+
+
+def correlate_factors(factors_mat, values, num_permutations=0, correction='max', seed=0, num_workers=1):
+    """Correlations between factors and targets with parametric p-values, or with permutation
+    p-values corrected according to correction ("max", "fdr" or "none") if num_permutations
+    is positive.
+    """
+    corr, p = pearson_matrix(factors_mat, values)
+    if num_permutations > 0:
+        p_cells, p_max = permutation_test(factors_mat, values, corr, num_permutations, seed, num_workers)
+        if correction == 'max':
+            p = p_max
+        elif correction == 'fdr':
+            p = fdr(p_cells)
+        else:
+            p = p_cells
+    return corr, p
+
+
+def _attach(name):
+    from multiprocessing import shared_memory
+    try:
+        # attaching processes should not unlink the block when they exit
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _correlate_shared(name, shape, rows, values, num_permutations, correction, seed):
+    """Runs correlate_factors on some rows of a factor matrix held in shared memory.
+    """
+    block = _attach(name)
+    try:
+        factors_mat = np.ndarray(shape, dtype=bool, buffer=block.buf)[rows]
+        return correlate_factors(factors_mat, values, num_permutations, correction, seed)
+    finally:
+        block.close()
+
+
+def correlate_many(factor_matrices, tasks, num_permutations=0, correction='max', seed=0, num_workers=1):
+    """Runs many correlations against a few factor matrices. factor_matrices maps a name to a
+    boolean matrix of days x factors, and each task is a tuple (name, rows, values) with the
+    rows of the matrix to use and the matching matrix of target values. The factor matrices
+    are placed in shared memory once and the tasks are spread over num_workers processes.
+    Returns the (corr, p) pair of each task.
+    """
+    if num_workers <= 1:
+        return [correlate_factors(factor_matrices[name][rows], values, num_permutations, correction, seed)
+                for name, rows, values in tasks]
+
+    from multiprocessing import shared_memory
+    from concurrent.futures import ProcessPoolExecutor
+    blocks = {}
+    try:
+        for name, mat in factor_matrices.items():
+            blocks[name] = shared_memory.SharedMemory(create=True, size=max(mat.nbytes, 1))
+            np.ndarray(mat.shape, dtype=bool, buffer=blocks[name].buf)[:] = mat
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_correlate_shared, blocks[name].name, factor_matrices[name].shape, rows,
+                                       values, num_permutations, correction, seed)
+                       for name, rows, values in tasks]
+            return [future.result() for future in futures]
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+
+
+if __name__ == '__main__':
+    # check on random data: a factor present every day must not hide a real effect from the
+    # max-statistic correction, and an always missing target must be left out
+    rng = np.random.default_rng(0)
+    factors_mat = rng.random((500, 15)) < 0.3
+    factors_mat[:, 0] = True
+    values = rng.normal(size=(500, 2)) + factors_mat[:, [3]]
+    values[rng.random(500) < 0.2, 0] = np.nan
+    values = np.column_stack((values, np.full(500, 2.)))
+    corr, p = correlate_factors(factors_mat, values, num_permutations=200)
+    assert np.isnan(p[0]).all() and np.isnan(p[:, 2]).all()
+    assert (p[3, :2] == 1 / 201).all(), p[3]
+    print("ok")
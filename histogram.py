@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 from my_calendar import Calendar
+from timings import enable_from_argv
 
 
+enable_from_argv()
 calendar = Calendar()
 calendar.histogram()
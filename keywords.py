@@ -0,0 +1,128 @@
+import re
+import numpy as np
+from storage import write_atomic
+
+
+TOKEN = re.compile(r'\w+')
+
+
+class KeywordIndex:
+    def __init__(self, path, stamp):
+        """Inverted index of the text fields, mapping each field to a dictionary of token ->
+        sorted array of the ordinals of the days containing it. The index is stored in path
+        together with the stamp of the database it was built from.
+        """
+        self.path = path
+        self.stamp = stamp
+        self.postings = {}
+
+    @classmethod
+    def load(cls, path, stamp):
+        """Loads the index from path, returns None if it is missing or was built for another
+        state of the database.
+        """
+        try:
+            with np.load(path) as data:
+                if str(data['stamp']) != stamp:
+                    return None
+                index = cls(path, stamp)
+                for field in data['fields']:
+                    tokens = data[f'{field}.tokens']
+                    ordinals = np.split(data[f'{field}.ordinals'], data[f'{field}.indptr'][1:-1])
+                    index.postings[str(field)] = dict(zip(tokens.tolist(), ordinals))
+                return index
+        except (OSError, KeyError, ValueError):
+            return None
+
+    @classmethod
+    def build(cls, path, stamp, columns, fields):
+        """Builds the index of the given text fields from the columns of the database.
+        """
+        index = cls(path, stamp)
+        for field in fields:
+            column = columns.text(field)
+            days = {}
+            for day_index in np.flatnonzero(column.present):
+                ordinal = int(columns.ordinals[day_index])
+                for token in set(TOKEN.findall(column[day_index])):
+                    days.setdefault(token, []).append(ordinal)
+            index.postings[field] = {token: np.array(ordinals, dtype=np.int32) for token, ordinals in days.items()}
+        return index
+
+    def save(self):
+        arrays = {'stamp': np.array(self.stamp), 'fields': np.array(list(self.postings), dtype=str)}
+        for field, postings in self.postings.items():
+            lengths = [len(ordinals) for ordinals in postings.values()]
+            arrays[f'{field}.tokens'] = np.array(list(postings), dtype=str)
+            arrays[f'{field}.indptr'] = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+            arrays[f'{field}.ordinals'] = (np.concatenate(list(postings.values())) if postings
+                                           else np.zeros(0, dtype=np.int32))
+        write_atomic(self.path, lambda f: np.savez(f, **arrays), binary=True)
+
+    def update(self, field, ordinal, old_text, new_text):
+        """Moves one day from the tokens of its old text to the tokens of its new text.
+        """
+        postings = self.postings.setdefault(field, {})
+        old_tokens = set(TOKEN.findall(old_text)) if old_text else set()
+        new_tokens = set(TOKEN.findall(new_text)) if new_text else set()
+        for token in old_tokens - new_tokens:
+            ordinals = postings.get(token)
+            if ordinals is not None:
+                ordinals = ordinals[ordinals != ordinal]
+                if len(ordinals):
+                    postings[token] = ordinals
+                else:
+                    del postings[token]
+        for token in new_tokens - old_tokens:
+            ordinals = postings.get(token, np.zeros(0, dtype=np.int32))
+            position = np.searchsorted(ordinals, ordinal)
+            if position == len(ordinals) or ordinals[position] != ordinal:
+                postings[token] = np.insert(ordinals, position, ordinal)
+
+    def search(self, field, keyword):
+        """Finds the days whose text in field contains keyword as a substring. Returns the
+        sorted ordinals of the candidate days and whether they are exact. Candidates are exact
+        for keywords made of a single run of word characters, since any occurrence lies
+        inside a token containing the keyword. Otherwise each run of word characters must
+        appear inside some token and the candidates need to be verified. Returns None if the
+        keyword has no word characters and the index cannot help.
+        """
+        fragments = TOKEN.findall(keyword)
+        if not fragments:
+            return None
+        postings = self.postings.get(field, {})
+        candidates = None
+        for fragment in fragments:
+            matches = [ordinals for token, ordinals in postings.items() if fragment in token]
+            ordinals = np.unique(np.concatenate(matches)) if matches else np.zeros(0, dtype=np.int32)
+            candidates = ordinals if candidates is None else np.intersect1d(candidates, ordinals)
+        return candidates, TOKEN.fullmatch(keyword) is not None
+
+
+class Matcher:
+    def __init__(self, keywords):
+        """Finds every occurrence of several keywords in a single pass of one compiled regular
+        expression. The expression is a lookahead over the keywords sorted from longest to
+        shortest, so it reports the longest keyword starting at each position; the shorter
+        ones starting there are necessarily its prefixes and are added from a table.
+        """
+        self.keywords = sorted({keyword for keyword in keywords if keyword}, key=len, reverse=True)
+        self.regex = re.compile('(?=(' + '|'.join(map(re.escape, self.keywords)) + '))') if self.keywords else None
+        self.prefixes = {keyword: [prefix for prefix in self.keywords if keyword.startswith(prefix)]
+                         for keyword in self.keywords}
+
+    def spans(self, text):
+        """Returns a (start, end, keyword) tuple for every occurrence, overlapping ones included.
+        """
+        spans = []
+        if self.regex is not None:
+            for match in self.regex.finditer(text):
+                start = match.start()
+                for keyword in self.prefixes[match.group(1)]:
+                    spans.append((start, start + len(keyword), keyword))
+        return spans
+
+    def found(self, text):
+        """Returns the set of keywords that occur in the text.
+        """
+        return {keyword for _, _, keyword in self.spans(text)}
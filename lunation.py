@@ -0,0 +1,93 @@
+import numpy as np
+from datetime import date
+from storage import write_atomic
+
+
+# observer used for the visible fraction, as in the original moon.py (ephem reads floats as radians)
+latitude = 37.3891
+longitude = 5.9845
+# ephem dates count days from noon of the last day of 1899
+EPHEM_EPOCH = date(1899, 12, 31).toordinal()
+# fields computed from the date of each day, usable as any numeric field of the database
+fields = {
+    'moon': {'type': float, 'range': (0, 1)},  # visible fraction of the moon at noon
+    'lunation': {'type': float, 'range': (0, 1)},  # time since the last new moon over the lunation length
+}
+
+
+def ordinals_to_ephem(ordinals):
+    """Converts day ordinals to ephem dates at noon UT.
+    """
+    return np.asarray(ordinals, dtype=np.float64) - EPHEM_EPOCH
+
+
+class LunationTable:
+    def __init__(self, new_moons, first_ordinal, fractions, location):
+        """Times of all the new moons around a span of days, as ephem dates, and the visible
+        fraction of the moon at noon of every day of the span, starting on first_ordinal.
+        """
+        self.new_moons = new_moons
+        self.first_ordinal = first_ordinal
+        self.fractions = fractions
+        self.location = location
+
+    @classmethod
+    def build(cls, first_ordinal, last_ordinal, location=(latitude, longitude)):
+        """Computes the table with ephem, which is slow: each new moon is an iterative search.
+        """
+        import ephem
+
+        observer = ephem.Observer()
+        observer.lat, observer.long = location
+        moon = ephem.Moon()
+        fractions = np.empty(last_ordinal - first_ordinal + 1)
+        for day, ephem_date in enumerate(ordinals_to_ephem(np.arange(first_ordinal, last_ordinal + 1))):
+            observer.date = ephem_date
+            moon.compute(observer)
+            fractions[day] = moon.moon_phase
+
+        # one new moon before the first day and one after the last
+        new_moons = [float(ephem.previous_new_moon(ordinals_to_ephem(first_ordinal)))]
+        while new_moons[-1] <= ordinals_to_ephem(last_ordinal):
+            new_moons.append(float(ephem.next_new_moon(new_moons[-1] + 1)))
+        return cls(np.array(new_moons), first_ordinal, fractions, location)
+
+    @classmethod
+    def load(cls, path):
+        """Loads the table from path, returns None if it is missing or unreadable.
+        """
+        try:
+            with np.load(path) as data:
+                return cls(data['new_moons'], int(data['first_ordinal']), data['fractions'],
+                           tuple(data['location'].tolist()))
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path):
+        write_atomic(path, lambda f: np.savez(f, new_moons=self.new_moons, first_ordinal=self.first_ordinal,
+                                              fractions=self.fractions, location=np.array(self.location)),
+                     binary=True)
+
+    @property
+    def last_ordinal(self):
+        return self.first_ordinal + len(self.fractions) - 1
+
+    def covers(self, first_ordinal, last_ordinal, location=(latitude, longitude)):
+        return (self.first_ordinal <= first_ordinal and last_ordinal <= self.last_ordinal
+                and tuple(self.location) == tuple(location))
+
+    def lunation(self, ordinals):
+        """Returns the fraction of the lunation elapsed at noon of each day, from 0 at a new
+        moon to 1 at the next one.
+        """
+        times = ordinals_to_ephem(ordinals)
+        following = np.searchsorted(self.new_moons, times, side='right')
+        previous_moon = self.new_moons[following - 1]
+        return (times - previous_moon) / (self.new_moons[following] - previous_moon)
+
+    def fraction(self, ordinals):
+        """Returns the visible fraction of the moon at noon of each day, interpolated for days
+        given as fractional ordinals.
+        """
+        days = np.arange(self.first_ordinal, self.last_ordinal + 1)
+        return np.interp(np.asarray(ordinals, dtype=np.float64), days, self.fractions)
@@ -1,36 +1,26 @@
 import numpy as np
-from datetime import datetime, timedelta
-import ephem
 import matplotlib.pyplot as plt
 from my_calendar import Calendar
+from timings import enable_from_argv, stage
 
 
+enable_from_argv()
 calendar = Calendar()
 
-g = ephem.Observer()
-g.name = 'sevilla'
-g.lat = 37.3891
-g.long = 5.9845
-
-m = ephem.Moon()
-
-moon_phases = []
-lunations = []
-
-for day in calendar.database:
-    if "pain" in day:
-        if day["pain"]:
-            g.date = datetime.strptime(f"{day['date']} 12:00", "%Y-%m-%d %H:%M")
-            m.compute(g)
-            moon_phases.append(m.moon_phase)
-
-            nnm = ephem.next_new_moon(g.date)
-            pnm = ephem.previous_new_moon(g.date)
-            lunation = (g.date - pnm) / (nnm - pnm)
-            lunations.append(lunation)
+# moon phases of every day come from the lunation table, computed once and cached
+with stage('moon positions'):
+    table = calendar.lunation_table()
+    all_ordinals = calendar.columns.ordinals
+    pain_ordinals = all_ordinals[calendar.columns.flags('pain')]
+    moon_phases = table.fraction(pain_ordinals)
+    lunations = table.lunation(pain_ordinals)
 
 print(moon_phases[-1])
 n, bins, _ = plt.hist(moon_phases, bins=12)
+# distribution expected if migraines did not depend on the moon
+weights = np.full(len(all_ordinals), len(moon_phases) / len(all_ordinals))
+plt.hist(table.fraction(all_ordinals), bins=bins, weights=weights, histtype='step', color='k', label="All days")
+plt.legend()
 plt.xlabel("Visible fraction")
 plt.ylabel("Migraine count")
 plt.tight_layout()
@@ -50,4 +40,5 @@ plt.ylabel("Visible fraction")
 # ax.plot(np.append(bin_centers, bin_centers[0]), np.append(n, [n[0]]), 'o-')
 
 
-plt.show()
+with stage('show'):
+    plt.show()
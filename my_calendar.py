@@ -1,43 +1,178 @@
 import os
+import sys
 import json
+import shlex
 import calendar
 import argparse
 import tempfile
 import math
 import locale
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from subprocess import call
-from scipy.stats.stats import pearsonr
-from scipy.stats import lognorm, gamma, norm
+from subprocess import PIPE, Popen, call
 from datetime import date, datetime, timedelta
 from config import path, fields
+from columns import Columns, ordinals_to_dates, dates_to_ordinals
+from storage import Journal, cache_path, read_database, stamp, write_database
+from keywords import KeywordIndex, Matcher
+from queries import QueryCache
+from correlation import correlate_factors, correlate_many
+from timings import stage, timed
+from lunation import LunationTable, fields as derived_fields
+from shuffle import shuffle_percentiles
 
 
 class Calendar:
+    # number of journal entries after which the database file is rewritten
+    max_journal_entries = 200
+    # number of days formatted before each write to the terminal
+    display_batch_size = 50
+    # number of get_values results kept in memory, and whether they are also kept on disk
+    query_cache_size = 64
+    query_cache_on_disk = False
+
     def __init__(self):
         """Reads the database path and fields from a configuration file and loads the database.
         """
-        # Load database
+        self.active_fields = fields['active']
+        self.all_fields = {**fields['active'], **fields['inactive'], **derived_fields}
+        # derived fields are computed from the date instead of being stored
+        self.derived = {'moon': lambda ordinals: self.lunation_table().fraction(ordinals),
+                        'lunation': lambda ordinals: self.lunation_table().lunation(ordinals)}
+        self.lunations = None
+
+        # one matcher per text field for the keywords of the implicit fields found in it
+        keywords = {}
+        for field_specs in self.all_fields.values():
+            if 'match' in field_specs:
+                keywords.setdefault(field_specs['in'], []).append(field_specs['match'])
+        self.matchers = {field_name: Matcher(field_keywords) for field_name, field_keywords in keywords.items()}
+
+        # Load database and replay the changes journaled since it was last written
         self.path = path
+        self.journal = Journal(self.path + '.journal')
         try:
-            with open(self.path, 'r', encoding='utf-8') as f:
-                self.database = json.load(f)
+            with stage('read database'):
+                self.database = read_database(self.path)
         except FileNotFoundError:
             print('Database not found, creating a new one...')
             self.database = []
-            self.dump()
-
-        self.active_fields = fields['active']
-        self.all_fields = {**fields['active'], **fields['inactive']}
-
-    def dump(self):
-        """Writes to the database file.
+            write_database(self.path, self.database)
+        with stage('replay journal'):
+            self.journal.replay(self.database)
+
+        with stage('parse dates'):
+            self.columns = Columns(self.database, self.all_fields, self.derived)
+        self.keywords = None
+        self.queries = QueryCache(stamp(self.path, self.journal.path), self.query_cache_size,
+                                  cache_path(self.path, '.queries') if self.query_cache_on_disk else None)
+
+    @timed
+    def dump(self, changed=None, old_days=None):
+        """Persists the database and refreshes the columnar view. If the indices of the
+        changed days are given, only those days are appended to the journal. Otherwise, or
+        once the journal grows too long, the database file is rewritten atomically and the
+        journal is cleared, as it is when the journal could not match the changed days to
+        their dates on replay. A path ending in .bin selects the binary format. old_days maps
+        the indices of the changed days that already existed to their previous contents,
+        which are needed to update the keyword index.
         """
-        with open(self.path, 'w', encoding='utf-8') as f:
-            json.dump(self.database, f, indent=4, separators=(',', ': '), ensure_ascii=False)
-
+        previous_stamp = stamp(self.path, self.journal.path)
+        old_columns = self.columns
+        if (changed is not None and self.journal.num_entries + len(changed) <= self.max_journal_entries
+                and self.journal_matches(changed, old_columns)):
+            with stage('append to journal'):
+                self.journal.append(self.database, changed)
+        else:
+            with stage('write database'):
+                write_database(self.path, self.database)
+                self.journal.clear()
+        with stage('parse dates'):
+            self.columns = Columns(self.database, self.all_fields, self.derived)
+        with stage('update keyword index'):
+            self.update_keyword_index(previous_stamp, old_columns, changed, old_days or {})
+        self.queries.invalidate(stamp(self.path, self.journal.path))
+
+    def journal_matches(self, changed, old_columns):
+        """Tells whether replaying the journal records of the changed days would find them
+        again by date: existing days must keep their dates and new days must come after the
+        day before them.
+        """
+        for day_index in changed:
+            day_date = self.database[day_index]['date']
+            if day_index < len(old_columns):
+                if date.fromisoformat(day_date).toordinal() != old_columns.ordinals[day_index]:
+                    return False
+            elif day_index > 0 and day_date <= self.database[day_index - 1]['date']:
+                return False
+        return True
+
+    def keyword_index(self):
+        """Returns the inverted index of the text fields, loading it from the cache folder or
+        building it if it does not match the current state of the database.
+        """
+        if self.keywords is None:
+            index_path = cache_path(self.path, '.keywords.npz')
+            current_stamp = stamp(self.path, self.journal.path)
+            self.keywords = KeywordIndex.load(index_path, current_stamp)
+            if self.keywords is None:
+                with stage('build keyword index'):
+                    text_fields = [name for name, specs in self.all_fields.items() if specs['type'] is str]
+                    self.keywords = KeywordIndex.build(index_path, current_stamp, self.columns, text_fields)
+                    self.keywords.save()
+        return self.keywords
+
+    def lunation_table(self):
+        """Returns the table of new moons and visible fractions of the moon, loading it from
+        the cache folder or computing it with ephem if it does not cover the span of the
+        database.
+        """
+        ordinals = self.columns.ordinals
+        if len(ordinals):
+            first_ordinal, last_ordinal = int(ordinals[0]), int(ordinals[-1])
+        else:
+            first_ordinal = last_ordinal = date.today().toordinal()
+        if self.lunations is None or not self.lunations.covers(first_ordinal, last_ordinal):
+            table_path = cache_path(self.path, '.lunations.npz')
+            self.lunations = LunationTable.load(table_path)
+            if self.lunations is None or not self.lunations.covers(first_ordinal, last_ordinal):
+                with stage('build lunation table'):
+                    if self.lunations is not None:
+                        first_ordinal = min(first_ordinal, self.lunations.first_ordinal)
+                        last_ordinal = max(last_ordinal, self.lunations.last_ordinal)
+                    # leave room for the days added in the next months
+                    self.lunations = LunationTable.build(first_ordinal, last_ordinal + 366)
+                    self.lunations.save(table_path)
+        return self.lunations
+
+    def update_keyword_index(self, previous_stamp, old_columns, changed, old_days):
+        """Moves the changed days to their new tokens in the keyword index, if there is one that
+        was up to date before the change and the previous contents of the changed days that
+        already existed are in old_days. Otherwise it will be rebuilt when it is needed.
+        """
+        if self.keywords is not None and self.keywords.stamp == previous_stamp:
+            index = self.keywords
+        else:
+            index = KeywordIndex.load(cache_path(self.path, '.keywords.npz'), previous_stamp)
+        self.keywords = None
+        if index is None or changed is None:
+            return
+        # the old columns read the database lazily, so they may already hold the new texts
+        if any(day_index < len(old_columns) and day_index not in old_days for day_index in changed):
+            return
+
+        for field in index.postings:
+            new_texts = self.columns.text(field)
+            for day_index in changed:
+                if day_index < len(old_columns):
+                    old_text = old_days[day_index].get(field)
+                    index.update(field, int(old_columns.ordinals[day_index]),
+                                 old_text if isinstance(old_text, str) else None, None)
+                index.update(field, int(self.columns.ordinals[day_index]), None, new_texts[day_index])
+        index.stamp = stamp(self.path, self.journal.path)
+        index.save()
+        self.keywords = index
+
+    @timed
     def reorder(self):
         """Reorders the database according to the configuration file.
         """
@@ -74,10 +209,13 @@ class Calendar:
     def fill_implicit_fields(self, day):
         """Checks for implicit fields and adds them to the day's dictionary.
         """
+        found = {}
         for field_name, field_specs in self.active_fields.items():
             if 'match' in field_specs:
                 if field_specs['in'] in day:
-                    day[field_name] = field_specs['match'] in day[field_specs['in']]
+                    if field_specs['in'] not in found:
+                        found[field_specs['in']] = self.matchers[field_specs['in']].found(day[field_specs['in']])
+                    day[field_name] = field_specs['match'] in found[field_specs['in']]
                 else:
                     day[field_name] = False
 
@@ -89,6 +227,7 @@ class Calendar:
         string += "            0   1   2   3   4   5   6   7   8   9   10\n"
         return string
 
+    @timed
     def add_days(self):
         """Fill in missing days in the database.
         """
@@ -99,7 +238,7 @@ class Calendar:
         args = parser.parse_args()
 
         if args.date is not None:
-            end_date = datetime.strptime(args.date, "%Y-%m-%d").date()
+            end_date = date.fromisoformat(args.date)
         else:
             end_date = date.today()
             if datetime.now().hour < 20:
@@ -108,7 +247,7 @@ class Calendar:
         if args.skip or len(self.database) == 0:
             start_date = end_date - timedelta(days=1)
         else:
-            start_date = datetime.strptime(self.database[-1]['date'], "%Y-%m-%d").date()
+            start_date = date.fromordinal(int(self.columns.ordinals[-1]))
 
         days_missing = (end_date - start_date).days
 
@@ -116,6 +255,7 @@ class Calendar:
         if days_missing == 0:
             print("\nAlready up to date\n")
         else:
+            first_new_index = len(self.database)
             for i in range(1, days_missing + 1):
                 processing_date = start_date + timedelta(days=i)
                 print("\nData for", calendar.day_name[processing_date.weekday()], processing_date, "\n")
@@ -130,21 +270,15 @@ class Calendar:
                 self.fill_implicit_fields(day)
                 self.database.append(day)
 
-            self.dump()
+            self.dump(changed=range(first_new_index, len(self.database)))
             print("\n")
 
     def date_to_index(self, processing_date):
         """Finds the index of the database entry corresponding to some date.
         """
-        if processing_date >= self.database[-1]['date']:
-            return len(self.database)-1
-        elif processing_date <= self.database[0]['date']:
-            return 0
-        else:
-            for index in range(len(self.database)-1, -1, -1):
-                if self.database[index]['date'] < processing_date:
-                    return index + 1
+        return self.columns.index(date.fromisoformat(processing_date).toordinal())
 
+    @timed
     def edit(self):
         """Opens VIM to edit one database entry.
         """
@@ -155,7 +289,7 @@ class Calendar:
         if args.date is not None:
             edit_index = self.date_to_index(args.date)
         else:
-            edit_index = -1
+            edit_index = len(self.database) - 1
 
         day = json.dumps(self.database[edit_index], indent=4, separators=(',', ': '), ensure_ascii=False)
 
@@ -170,9 +304,10 @@ class Calendar:
             tf.seek(len(initial_string))
             edited_day = json.loads(tf.read())
             self.fill_implicit_fields(edited_day)
+            old_day = self.database[edit_index]
             self.database[edit_index] = edited_day
 
-        self.dump()
+        self.dump(changed=[edit_index], old_days={edit_index: old_day})
 
     def index_range(self, num_days=None, last_date=None):
         """Finds the first and last index corresponding to a period of num_days ending on the
@@ -180,188 +315,302 @@ class Calendar:
         """
         if last_date is None:
             last_index = len(self.database) - 1
-            last_date = self.database[last_index]['date']
+            last_ordinal = int(self.columns.ordinals[last_index])
         else:
-            last_index = self.date_to_index(last_date)
+            last_ordinal = date.fromisoformat(last_date).toordinal()
+            last_index = self.columns.index(last_ordinal)
 
         if num_days <= 0:
             first_index = 0
         else:
-            first_date = datetime.strptime(last_date, "%Y-%m-%d").date() - timedelta(days=num_days - 1)
-            first_date = first_date.strftime("%Y-%m-%d")
-            first_index = self.date_to_index(first_date)
+            first_index = self.columns.index(last_ordinal - (num_days - 1))
 
         return first_index, last_index + 1
 
+    @timed
     def display(self):
         """Displays on the terminal a period of num_days ending on the
         last date.
         """
-        print("\n")
-
         parser = argparse.ArgumentParser()
         parser.add_argument("num_days", type=int, help="number of days to display")
         parser.add_argument("-d", "--date", help="last date to display")
+        parser.add_argument("-p", "--pager", action="store_true", help="send the output to $PAGER (less by default)")
         args = parser.parse_args()
 
+        first_index, last_index = self.index_range(args.num_days, args.date)
+
+        if args.pager:
+            pager = Popen(shlex.split(os.environ.get('PAGER', 'less -R')), stdin=PIPE, encoding='utf-8')
+            stream = pager.stdin
+        else:
+            pager = None
+            stream = sys.stdout
+
+        # days are rendered and written in batches, so the first screen shows up immediately
+        try:
+            stream.write("\n\n")
+            batch = []
+            headers = self.day_headers(self.columns.ordinals[first_index:last_index])
+            for day_index, header in zip(range(first_index, last_index), headers):
+                batch.append(self.format_day(self.database[day_index], header))
+                if len(batch) == self.display_batch_size:
+                    stream.write(''.join(batch))
+                    stream.flush()
+                    batch = []
+            stream.write(''.join(batch) + "\n\n")
+            stream.flush()
+        except BrokenPipeError:
+            # the pager was closed before reaching the end
+            pass
+        finally:
+            if pager is not None:
+                try:
+                    stream.close()
+                except BrokenPipeError:
+                    pass
+                pager.wait()
+
+    @staticmethod
+    def day_headers(ordinals):
+        """Returns the date and weekday that start the display of each of the days in ordinals,
+        formatted all at once from the ordinals.
+        """
+        day_names = [calendar.day_name[weekday] for weekday in range(7)]
+        padded_names = [name + " " * (12 - len(name)) for name in day_names]
+        date_strings = np.datetime_as_string(ordinals_to_dates(ordinals), unit='D')
+        # ordinal 1 was a Monday
+        weekdays = (np.asarray(ordinals, dtype=np.int64) - 1) % 7
+        return [date_string + "  " + padded_names[weekday] for date_string, weekday in zip(date_strings, weekdays.tolist())]
+
+    def format_day(self, day, header=None):
+        """Formats a day for display, numbers colored from white to green following their range
+        and text in light brown with the keywords of implicit fields in light blue. Colors are
+        applied to whole runs of characters. The header with the date can be given if it was
+        already made by day_headers.
+        """
         brown = '\033[38;5;180m'
         blue = '\033[38;5;153m'
         reset = '\033[0m'
 
-        first_index, last_index = self.index_range(args.num_days, args.date)
-
-        for day_index in range(first_index, last_index):
-            day = self.database[day_index]
-            processing_date = datetime.strptime(day['date'], "%Y-%m-%d").date()
-            string = processing_date.strftime("%Y-%m-%d  %A")
-            string += " " * (12 - len(string.split()[1]))
-
-            # print all numbers first
-            for field_name, value in day.items():
-                if field_name == "date":
-                    continue
-                if type(value) is int or type(value) is float:
-                    if field_name in self.all_fields and 'range' in self.all_fields[field_name]:
-                        # print numbers following color gradient from 0:white to 10:green
-                        minimum, maximum = self.all_fields[field_name]['range']
-                        rb = str(int((1 - (value - minimum) / (maximum - minimum)) * 255))
-                        color = '\033[38;2;' + rb + ';255;' + rb + 'm'
-                        string += field_name + ': ' + color + str(value) + reset + '  '
-                    else:
-                        string += field_name + ': ' + str(value) + '  '
-
-            # print text fields
-            for field_name, value in day.items():
-                if field_name == "date":
-                    continue
-                if type(value) is str:
-                    # print strings in light brown, with implicit field keywords in light blue
-                    string += '\n' + field_name + ': '
-                    indices_implicit = []
-
-                    for f_name, f_specs in self.all_fields.items():
-                        if 'in' in f_specs and f_specs['in'] == field_name:
-                            keyword = f_specs['match']
-                            if keyword in value:
-                                start = value.index(keyword)
-                                end = start + len(keyword)
-                                indices_implicit += list(range(start, end))
-
-                    for letter_index, letter in enumerate(value):
-                        if letter_index in indices_implicit:
-                            string += blue + letter + reset
-                        else:
-                            string += brown + letter + reset
-
-            print(string + '\n')
-        print("\n")
+        if header is None:
+            header, = self.day_headers([date.fromisoformat(day['date']).toordinal()])
+        parts = [header]
+
+        # print all numbers first
+        for field_name, value in day.items():
+            if field_name == "date":
+                continue
+            if type(value) is int or type(value) is float:
+                if field_name in self.all_fields and 'range' in self.all_fields[field_name]:
+                    # print numbers following color gradient from 0:white to 10:green
+                    minimum, maximum = self.all_fields[field_name]['range']
+                    rb = str(int((1 - (value - minimum) / (maximum - minimum)) * 255))
+                    color = '\033[38;2;' + rb + ';255;' + rb + 'm'
+                    parts += [field_name, ': ', color, str(value), reset, '  ']
+                else:
+                    parts += [field_name, ': ', str(value), '  ']
+
+        # print text fields
+        for field_name, value in day.items():
+            if field_name == "date":
+                continue
+            if type(value) is str:
+                parts += ['\n', field_name, ': ']
+                spans = self.matchers[field_name].spans(value) if field_name in self.matchers else []
+                position = 0
+                for start, end, keyword in sorted(spans):
+                    if end <= position:
+                        continue
+                    if start > position:
+                        parts += [brown, value[position:start], reset]
+                    parts += [blue, value[max(start, position):end], reset]
+                    position = end
+                if position < len(value):
+                    parts += [brown, value[position:], reset]
+
+        parts.append('\n\n')
+        return ''.join(parts)
 
     def read_values(self, field, first_index, last_index):
         """Reads the values of one field from the database.
         """
-        dates = []
-        values = []
-        for day in self.database[first_index:last_index]:
-            if field in day:
-                dates.append(datetime.strptime(day['date'], "%Y-%m-%d").date())
-                values.append(day[field])
-
-        if 'range' in self.all_fields[field]:
-            minimum, maximum = self.all_fields[field]['range']
-            values = (np.array(values) - minimum) / (maximum - minimum) * 10
-        elif self.all_fields[field]['type'] == bool:
-            values = np.array(values)*10
-
-        dates, values = self.add_nans(dates, values)
-        return np.array(dates), np.array(values)
+        present, values = self.field_values(field, first_index, last_index)
+        ordinals = self.columns.ordinals[first_index:last_index][present]
+        dates, (values,) = self.fill_gaps(ordinals, values[present])
+        return dates, values
+
+    def field_values(self, field, first_index, last_index):
+        """Returns a mask of the days in the range that have the field and the values of the
+        field in all of them, scaled to 0-10 for bools and fields with a range, and NaN where
+        the field is missing.
+        """
+        present = self.columns.present(field)[first_index:last_index]
+        if self.columns.kind(field) == 'bool':
+            values = self.columns.flags(field)[first_index:last_index] * 10.
+        else:
+            values = self.columns.numbers(field)[first_index:last_index]
+            if 'range' in self.all_fields[field]:
+                minimum, maximum = self.all_fields[field]['range']
+                values = (values - minimum) / (maximum - minimum) * 10
+        return present, np.where(present, values, np.nan)
 
     @staticmethod
-    def add_nans(dates, values):
-        nan_dates = [dates[0]]
-        nan_values = [values[0]]
-        for day_date, value in zip(dates[1:], values[1:]):
-            if nan_dates[-1] != np.nan and day_date - nan_dates[-1] > timedelta(days=1):
-                nan_dates.append(nan_dates[-1] + timedelta(days=1))
-                nan_values.append(np.nan)
-            nan_dates.append(day_date)
-            nan_values.append(value)
-        return nan_dates, nan_values
+    def fill_gaps(ordinals, *values):
+        """Places one or more arrays of values, given for the days in ordinals, on a grid with
+        one entry per day between the first and the last of them. Missing days are NaN.
+        Returns the datetime64 dates of the grid and a list with one array per input.
+        """
+        if len(ordinals) == 0:
+            return ordinals_to_dates([]), [np.array([]) for _ in values]
+        offsets = ordinals - ordinals[0]
+        filled = np.full((len(values), offsets[-1] + 1), np.nan)
+        for row, row_values in zip(filled, values):
+            row[offsets] = row_values
+        return ordinals_to_dates(np.arange(ordinals[0], ordinals[-1] + 1)), list(filled)
 
     @staticmethod
     def intervals(all_dates, values):
         """Calculates the time intervals between occurrences of a boolean variable.
         """
-        dates = []
-        intervals = []
-        indices = np.nonzero(values == 10)[0]
-        for left, right in zip(indices[:len(indices)-1], indices[1:]):
-            dates.append(all_dates[right])
-            intervals.append((all_dates[right] - all_dates[left]).days)
-        return np.array(dates), np.array(intervals)
+        dates = all_dates[np.nonzero(values == 10)[0]]
+        return dates[1:], (dates[1:] - dates[:-1]).astype(int)
 
     @staticmethod
     def moving_average(dates, values, window_size):
-        """Calculates a moving average over a window of size window_size.
-        """
-        first_date = dates[0]
-        num_days = (dates[-1] - first_date).days + 1
-
-        out_dates = []
-        out_values = []
-        for day_num in range(0, num_days-window_size+1):
-            left = first_date + timedelta(days=day_num)
-            right = left + timedelta(days=window_size-1)
-            if right in dates:
-                selected_values = values[(dates >= left) & (dates <= right)]
-                out_dates.append(right)
-                if ~np.isnan(selected_values[-1]):
-                    out_values.append(np.nanmean(selected_values))
-                else:
-                    out_values.append(np.nan)
-
-        return out_dates, out_values
+        """Calculates a moving average over a window of size window_size. The values are placed
+        on a grid with one slot per day, so that the sum over each window is a difference of
+        cumulative sums. Windows are reported on the days present in dates, as NaN if the
+        value on that day is NaN, and otherwise as the mean of the non NaN values they cover.
+        """
+        if len(dates) == 0:
+            return ordinals_to_dates([]), np.array([])
+
+        ordinals = dates_to_ordinals(dates)
+        offsets = ordinals - ordinals[0]
+        values = np.asarray(values, dtype=float)
+        num_days = offsets[-1] + 1
+
+        valid = ~np.isnan(values)
+        cum_sums = np.zeros(num_days + 1)
+        cum_counts = np.zeros(num_days + 1)
+        np.cumsum(np.bincount(offsets[valid], weights=values[valid], minlength=num_days), out=cum_sums[1:])
+        np.cumsum(np.bincount(offsets[valid], minlength=num_days), out=cum_counts[1:])
+
+        present = np.zeros(num_days, dtype=bool)
+        present[offsets] = True
+        last_values = np.full(num_days, np.nan)
+        last_values[offsets] = values
+
+        ends = np.arange(window_size - 1, num_days)
+        ends = ends[present[ends]]
+        window_sums = cum_sums[ends + 1] - cum_sums[ends + 1 - window_size]
+        window_counts = cum_counts[ends + 1] - cum_counts[ends + 1 - window_size]
+        out_values = np.where(np.isnan(last_values[ends]), np.nan, window_sums / np.maximum(window_counts, 1))
+
+        return ordinals_to_dates(ordinals[0] + ends), out_values
+
+    def find_keyword(self, field, keyword, first_index, last_index):
+        """Returns a boolean array telling which days in the range contain the keyword in the
+        field, looked up in the keyword index whenever it can answer the query.
+        """
+        column = self.columns.text(field)
+        index = self.keyword_index()
+        result = index.search(field, keyword) if field in index.postings else None
+        if result is None:
+            return column.contains(keyword, first_index, last_index)
+
+        ordinals, exact = result
+        day_indices = self.columns.lookup(ordinals)
+        day_indices = day_indices[(day_indices >= first_index) & (day_indices < last_index)]
+        if not exact:
+            day_indices = np.array([i for i in day_indices if keyword in column[i]], dtype=np.int64)
+        found = np.zeros(last_index - first_index, dtype=bool)
+        found[day_indices - first_index] = True
+        return found
 
     def keyword_to_bool(self, field, keyword, first_index, last_index):
-        dates = []
-        values = []
-        for day in self.database[first_index:last_index]:
-            keyword_found = False
-            if field in day and keyword in day[field]:
-                keyword_found = True
-            values.append(keyword_found)
-            dates.append(datetime.strptime(day['date'], "%Y-%m-%d").date())
-        dates, values = self.add_nans(dates, values)
-        return np.array(dates), np.array(values)*10
+        values = self.find_keyword(field, keyword, first_index, last_index)
+        dates, (values,) = self.fill_gaps(self.columns.ordinals[first_index:last_index], values)
+        return dates, values*10
 
+    @timed
     def get_values(self, complex_fields, first_index, last_index):
-        all_values = []
-        all_dates = []
-
-        for complex_field in complex_fields:
-            field = complex_field.split(':')[0].split('.')[0]
-            if ':' in complex_field:
-                keyword = complex_field.split(':')[1].split('.')[0]
-                dates, values = self.keyword_to_bool(field, keyword, first_index, last_index)
-            else:
-                dates, values = self.read_values(field, first_index, last_index)
-
-            if '.i' in complex_field:
-                dates, values = self.intervals(dates, values)
-
-            all_values.append(values)
-            all_dates.append(dates)
-
+        """Returns the dates and values of each complex field in the range. Results are cached
+        until the database changes, and their arrays are read-only. The fields that are not
+        cached are extracted together.
+        """
+        keys = [(complex_field, first_index, last_index) for complex_field in complex_fields]
+        results = {key: self.queries.get(key) for key in keys}
+        missing = [key for key, result in results.items() if result is None]
+        if missing:
+            extracted = self.extract_values([key[0] for key in missing], first_index, last_index)
+            for key, result in zip(missing, extracted):
+                results[key] = self.queries.put(key, *result)
+
+        all_dates = [results[key][0] for key in keys]
+        all_values = [results[key][1] for key in keys]
         return all_dates, all_values
 
-    def plot(self):
-        """Plotting function.
+    @staticmethod
+    def parse_complex_field(complex_field):
+        """Splits a complex field into its field, its keyword (or None) and whether the
+        intervals between occurrences are requested. Complex fields are a field,
+        field:keyword for the days whose field contains the keyword, and either of them
+        followed by .i for the intervals.
+        """
+        field = complex_field.split(':')[0].split('.')[0]
+        keyword = complex_field.split(':')[1].split('.')[0] if ':' in complex_field else None
+        return field, keyword, '.i' in complex_field
+
+    def extract_values(self, complex_fields, first_index, last_index):
+        """Computes the dates and values of several complex fields. The values of every field
+        are placed on a single grid of days covering the range, and each field is then cut
+        to the days between its first and last value, as read_values does.
+        """
+        plan = [self.parse_complex_field(complex_field) for complex_field in complex_fields]
+        ordinals = self.columns.ordinals[first_index:last_index]
+        masks = []
+        rows = []
+        for field, keyword, _ in plan:
+            if keyword is None:
+                present, values = self.field_values(field, first_index, last_index)
+            else:
+                present = np.ones(len(ordinals), dtype=bool)
+                values = self.find_keyword(field, keyword, first_index, last_index) * 10.
+            masks.append(present)
+            rows.append(values)
+
+        dates, filled = self.fill_gaps(ordinals, *rows)
+        offsets = ordinals - ordinals[0] if len(ordinals) else ordinals
+        results = []
+        for (field, keyword, intervals), present, values in zip(plan, masks, filled):
+            present_offsets = offsets[present]
+            if len(present_offsets):
+                start, stop = present_offsets[0], present_offsets[-1] + 1
+            else:
+                start = stop = 0
+            field_dates, field_values = dates[start:stop], values[start:stop]
+            if intervals:
+                field_dates, field_values = self.intervals(field_dates, field_values)
+            results.append((field_dates, field_values))
+        return results
+
+    @timed
+    def plot(self, argv=None, show=True):
+        """Plotting function. Arguments are read from argv, or from the command line if it is
+        None. Returns the figure, shown only if show is True.
         """
+        with stage('import matplotlib'):
+            import matplotlib.pyplot as plt
+            import matplotlib.dates as mdates
+
         parser = argparse.ArgumentParser()
         parser.add_argument("fields", help="fields to plot separated by commas (without spaces)")
         parser.add_argument("num_days", type=int, help="number of days to plot")
         parser.add_argument("-d", "--date", help="last date to plot")
         parser.add_argument("-a", "--average", type=int, help="window size in days")
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
 
         first_index, last_index = self.index_range(args.num_days, args.date)
 
@@ -417,10 +666,14 @@ class Calendar:
         formatter = mdates.ConciseDateFormatter(locator)
         ax.xaxis.set_major_locator(locator)
         ax.xaxis.set_major_formatter(formatter)
-        plt.show()
+        if show:
+            with stage('show'):
+                plt.show()
+        return fig
 
     @staticmethod
     def log_norm(data, max_x, ax):
+        from scipy.stats import lognorm
         shape, loc, scale = lognorm.fit(data)
         x = np.linspace(0, max_x, 100)
         pdf = lognorm.pdf(x, shape, loc, scale)
@@ -428,24 +681,31 @@ class Calendar:
 
     @staticmethod
     def gamma(data, max_x, ax):
+        from scipy.stats import gamma
         x = np.linspace(0, max_x, 100)
         ax.plot(x, gamma.pdf(x, *gamma.fit(data)), 'C1')
 
     @staticmethod
     def normal(data, max_x, ax):
+        from scipy.stats import norm
         x = np.linspace(0, max_x, 100)
         ax.plot(x, norm.pdf(x, *norm.fit(data)), 'C1')
 
-    def histogram(self):
-        """Plots a histogram.
+    @timed
+    def histogram(self, argv=None, show=True):
+        """Plots a histogram. Arguments are read from argv, or from the command line if it is
+        None. Returns the figure, shown only if show is True.
         """
+        with stage('import matplotlib'):
+            import matplotlib.pyplot as plt
+
         parser = argparse.ArgumentParser()
         parser.add_argument("field", help="fields to plot separated by commas (without spaces)")
         parser.add_argument("num_days", type=int, help="number of days to plot")
         parser.add_argument("size", type=float, help="bin size")
         parser.add_argument("-d", "--date", help="last date to plot")
         parser.add_argument("-f", "--fit", help="normal, log-normal or gamma", default=None)
-        args = parser.parse_args()
+        args = parser.parse_args(argv)
 
         first_index, last_index = self.index_range(args.num_days, args.date)
         values = self.get_values([args.field], first_index, last_index)[1][0]
@@ -466,104 +726,211 @@ class Calendar:
         ax.hist(values, bins=bins, range=hist_range, density=True)
 
         if args.fit is not None:
-            if args.fit == "normal":
-                self.normal(values[~np.isnan(values)], max_x, ax)
-            elif args.fit == "log-normal":
-                self.log_norm(values[~np.isnan(values)], max_x, ax)
-            elif args.fit == "gamma":
-                self.gamma(values[~np.isnan(values)], max_x, ax)
-            else:
-                print("distribution not recognized!")
+            with stage('fit'):
+                if args.fit == "normal":
+                    self.normal(values[~np.isnan(values)], max_x, ax)
+                elif args.fit == "log-normal":
+                    self.log_norm(values[~np.isnan(values)], max_x, ax)
+                elif args.fit == "gamma":
+                    self.gamma(values[~np.isnan(values)], max_x, ax)
+                else:
+                    print("distribution not recognized!")
 
         ax.spines[['right', 'top']].set_visible(False)
         plt.tight_layout()
-        plt.show()
-
-    def lists_to_mat(self, field, first_index, last_index, separator=', '):
-        """Transforms a field consisting on lists of items into a matrix of days x items.
-        """
-        # get the list of elements and how many times each of them appears
-        unsorted_list = []
-        unsorted_counts = []
-        dates = []
-        for day in self.database[first_index:last_index]:
-            if field in day:
-                dates.append(datetime.strptime(day['date'], "%Y-%m-%d").date())
-                for elem in day[field].split(separator):
-                    if elem in unsorted_list:
-                        unsorted_counts[unsorted_list.index(elem)] += 1
-                    else:
-                        unsorted_list.append(elem)
-                        unsorted_counts.append(1)
-
-        # sort factors by frequency
-        sorted_counts = sorted(unsorted_counts, reverse=True)
-        sorted_list = sorted(unsorted_list, reverse=True, key=lambda e: unsorted_counts[unsorted_list.index(e)])
+        if show:
+            with stage('show'):
+                plt.show()
+        return fig
+
+    @timed
+    def lists_to_mat(self, field, first_index, last_index, separator=', ', sparse=False, verbose=True):
+        """Transforms a field consisting on lists of items into a matrix of days x items. With
+        sparse=True the matrix is returned as a scipy.sparse CSR matrix. With verbose=True the
+        items are printed along with their counts.
+        """
+        column = self.columns.text(field)
+        texts = column.texts(first_index, last_index)
+        dates = ordinals_to_dates(self.columns.ordinals[first_index:last_index][column.present[first_index:last_index]])
+
+        # number the elements in order of first appearance and count how many times each appears
+        vocabulary = {}
+        codes = []
+        day_lengths = []
+        for text in texts:
+            elems = text.split(separator)
+            codes.extend([vocabulary.setdefault(elem, len(vocabulary)) for elem in elems])
+            day_lengths.append(len(elems))
+        codes = np.array(codes, dtype=np.int64)
+        rows = np.repeat(np.arange(len(texts)), day_lengths)
+        unsorted_list = list(vocabulary)
+        unsorted_counts = np.bincount(codes, minlength=len(unsorted_list))
+
+        # sort factors by frequency, ties keep their order of appearance
+        order = np.argsort(-unsorted_counts, kind='stable')
+        sorted_list = [unsorted_list[i] for i in order]
+        sorted_counts = unsorted_counts[order]
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order))
 
         # print sorted list
-        for factor, count in zip(sorted_list, sorted_counts):
-            print(count, factor)
-        print('\n')
+        if verbose:
+            for factor, count in zip(sorted_list, sorted_counts):
+                print(count, factor)
+            print('\n')
 
         # create matrix
-        mat = np.zeros((len(dates), len(sorted_list)), dtype=bool)
-        day_num = 0
-        for day in self.database[first_index:last_index]:
-            if field in day:
-                for factor in day[field].split(separator):
-                    mat[day_num, sorted_list.index(factor)] = True
-                day_num += 1
-        return np.array(dates), sorted_list, mat
-
-    def correlate(self, p_threshold=0.02):
-        """Correlates boolean variables contained in lists in factors_field with a multivalued variable."""
+        if sparse:
+            from scipy.sparse import csr_matrix
+            mat = csr_matrix((np.ones(len(codes), dtype=np.uint8), (rows, ranks[codes])),
+                             shape=(len(texts), len(sorted_list))).astype(bool)
+        else:
+            mat = np.zeros((len(texts), len(sorted_list)), dtype=bool)
+            mat[rows, ranks[codes]] = True
+        return dates, sorted_list, mat
+
+    def field_index_range(self, field):
+        """Finds the first and last index of the days that have a value for the field.
+        """
+        present = np.flatnonzero(self.columns.present(field))
+        if len(present) == 0:
+            return 0, len(self.database)
+        return present[0], present[-1] + 1
+
+    def shifted_values(self, field, ordinals, window):
+        """Returns a matrix of len(ordinals) x window with the values of a numeric field on each
+        of the days in ordinals shifted by 0 to window - 1 days, NaN where missing.
+        """
+        date_indices = self.columns.lookup(ordinals[:, np.newaxis] + np.arange(window))
+        return np.where(date_indices >= 0, self.columns.numbers(field)[date_indices], np.nan)
+
+    def event_ordinals(self, event_field):
+        """Returns the ordinals of the days where a bool field or a field:keyword is true.
+        """
+        all_dates, all_values = self.get_values([event_field], 0, len(self.database))
+        return dates_to_ordinals(all_dates[0][all_values[0] == 10])
+
+    def daily_series(self, complex_field):
+        """Returns the first ordinal and the values of a complex field on a grid with one entry
+        per day, NaN where missing.
+        """
+        all_dates, all_values = self.get_values([complex_field], 0, len(self.database))
+        ordinals = dates_to_ordinals(all_dates[0])
+        if len(ordinals) == 0:
+            return 0, np.array([])
+        series = np.full(ordinals[-1] - ordinals[0] + 1, np.nan)
+        series[ordinals - ordinals[0]] = all_values[0]
+        return int(ordinals[0]), series
+
+    @staticmethod
+    def align_series(series, first_ordinal, event_ordinals, side):
+        """Gathers the values of a daily series starting on first_ordinal, a 1d array or a matrix
+        of days x variables, from side days before to side days after each event. Events
+        closer than side days to the ends of the series are left out. Returns the ordinals of
+        the events kept and an events x offsets (x variables) array, taken from a strided view
+        of the windows of the series.
+        """
+        series = np.asarray(series, dtype=float)
+        days = np.asarray(event_ordinals, dtype=np.int64) - first_ordinal
+        days = days[(days >= side) & (days + side < len(series))]
+        if len(series) < 2 * side + 1:
+            return days + first_ordinal, np.zeros((0, 2 * side + 1) + series.shape[1:])
+        windows = np.lib.stride_tricks.sliding_window_view(series, 2 * side + 1, axis=0)
+        return days + first_ordinal, np.moveaxis(windows[days - side], -1, 1)
+
+    def align(self, event_field, target, side, num_shuffles=0, q=(5, 95), statistic='mean', seed=0,
+              num_workers=1):
+        """Aligns a complex field, or an external daily series given as a (first ordinal, values)
+        pair, to the days where event_field is true. Returns the ordinals of the events, the
+        events x offsets (x variables) array of values and, if num_shuffles is positive, the
+        null band: the percentiles q of the mean or the sum (statistic) over the events when
+        each of them is shifted by a random number of days in [-side, side), as a
+        len(q) (x variables) array.
+        """
+        first_ordinal, series = self.daily_series(target) if isinstance(target, str) else target
+        series = np.asarray(series, dtype=float)
+        events, aligned = self.align_series(series, first_ordinal, self.event_ordinals(event_field), side)
+        band = None
+        if num_shuffles > 0 and len(events):
+            with stage('shuffles'):
+                band = shuffle_percentiles(series.reshape(len(series), -1), events - first_ordinal, side,
+                                           num_shuffles, q, seed, num_workers, statistic)
+            band = band.reshape((len(q),) + series.shape[1:])
+        return events, aligned, band
+
+    @timed
+    def plot_aligned(self, argv=None, show=True):
+        """Plots the average of some fields around the days of an event, with the band of
+        averages expected if the events happened on random days nearby. Arguments are read
+        from argv, or from the command line if it is None. Returns the figure, shown only if
+        show is True.
+        """
+        with stage('import matplotlib'):
+            import matplotlib.pyplot as plt
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("event", help="bool field or field:keyword marking the events, for example pain")
+        parser.add_argument("fields", help="fields to align separated by commas (without spaces)")
+        parser.add_argument("side", type=int, help="number of days before and after the events")
+        parser.add_argument("-n", "--shuffles", type=int, default=1000, help="number of shuffles for the null band")
+        parser.add_argument("-s", "--seed", type=int, default=0, help="seed for the shuffles")
+        parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+        args = parser.parse_args(argv)
+
+        fig, ax = plt.subplots()
+        offsets = np.arange(-args.side, args.side + 1)
+        colors = plt.rcParams['axes.prop_cycle'].by_key()['color']
+        for plot_num, complex_field in enumerate(args.fields.split(',')):
+            color = colors[plot_num % len(colors)]
+            events, aligned, band = self.align(args.event, complex_field, args.side, args.shuffles, (5, 95),
+                                               'mean', args.seed, args.jobs)
+            with np.errstate(all='ignore'):
+                ax.plot(offsets, np.nanmean(aligned, axis=0), color=color, marker='.',
+                        label=f"{complex_field} ({len(events)} events)")
+            if band is not None:
+                ax.fill_between(offsets, band[0], band[1], color=color, alpha=0.2, edgecolor='none')
+
+        ax.axvline(0, color='k', linestyle=':')
+        ax.set_title(args.event)
+        ax.set_xlabel(f"Days from {args.event}")
+        ax.legend(loc='upper right')
+        ax.spines[['top', 'right']].set_visible(False)
+        if show:
+            with stage('show'):
+                plt.show()
+        return fig
+
+    @timed
+    def correlate(self, p_threshold=0.02, argv=None, show=True):
+        """Correlates boolean variables contained in lists in factors_field with a multivalued variable.
+        Arguments are read from argv, or from the command line if it is None. Returns the figure,
+        shown only if show is True.
+        """
+        with stage('import matplotlib'):
+            import matplotlib.pyplot as plt
+
         np.seterr(all='ignore')
         parser = argparse.ArgumentParser()
         parser.add_argument("factors_field", help="field containing lists of factors")
         parser.add_argument("values_field", help="field with values to correlate")
         parser.add_argument("-w", "--window", help="window size", default=5, type=int)
-        args = parser.parse_args()
-
-        first_index = 0
-        for day_num, day in enumerate(self.database):
-            if args.values_field in day:
-                first_index = day_num
-                break
-
-        last_index = len(self.database)
-        for day_num, day in enumerate(self.database[::-1]):
-            if args.values_field in day:
-                last_index = len(self.database) - day_num
-                break
-
+        parser.add_argument("-n", "--permutations", type=int, default=0,
+                            help="number of permutations for a permutation test (default: parametric p-values)")
+        parser.add_argument("-c", "--correction", choices=("max", "fdr", "none"), default="max",
+                            help="multiple comparison correction for the permutation test")
+        parser.add_argument("-s", "--seed", type=int, default=0, help="seed for the permutations")
+        parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+        args = parser.parse_args(argv)
+
+        first_index, last_index = self.field_index_range(args.values_field)
         factor_dates, factors_list, factors_mat = self.lists_to_mat(args.factors_field, first_index, last_index)
 
-        # calculate correlations
+        # calculate correlations for all factors and time shifts at once
         num_factors = len(factors_list)
-        corr = np.zeros((num_factors, args.window))
-        p = np.zeros((num_factors, args.window))
-
-        for time_shift in range(args.window):
-            values = []
-            for factor_date in factor_dates:
-                target_date = (factor_date + timedelta(days=time_shift)).strftime("%Y-%m-%d")
-                date_index = self.date_to_index(target_date)
-                if self.database[date_index]['date'] == target_date and args.values_field in self.database[date_index]:
-                    values.append(self.database[date_index][args.values_field])
-                else:
-                    values.append(np.nan)
-            values = np.array(values)
-            not_nan = ~np.isnan(values)
-            for factor_num in range(num_factors):
-                x = factors_mat[not_nan, factor_num]
-                y = values[not_nan]
-                if (x != x[0]).any() and (y != y[0]).any():
-                    fit = pearsonr(factors_mat[not_nan, factor_num], values[not_nan])
-                    corr[factor_num, time_shift] = fit[0]
-                    p[factor_num, time_shift] = fit[1]
-                else:
-                    corr[factor_num, time_shift] = np.nan
-                    p[factor_num, time_shift] = np.nan
+        with stage('statistics'):
+            values = self.shifted_values(args.values_field, dates_to_ordinals(factor_dates), args.window)
+            corr, p = correlate_factors(factors_mat, values, args.permutations, args.correction, args.seed,
+                                        args.jobs)
 
         # plot
         num_rows = 25
@@ -591,8 +958,135 @@ class Calendar:
             ax[col_num].set_yticklabels(factors_list[first_index:last_index])
             ax[col_num].xaxis.set_ticks_position('top')
         fig.colorbar(mat, cax=ax[-1])
-        plt.show()
+        if show:
+            with stage('show'):
+                plt.show()
+        return fig
+
+    @timed
+    def correlate_batch(self):
+        """Correlates every field containing lists of factors with every field with values and
+        saves all the correlation and p-value matrices in one .npz file. Each factors matrix is
+        built once over the whole database and shared by the worker processes.
+        """
+        parser = argparse.ArgumentParser()
+        parser.add_argument("factors_fields", help="fields containing lists of factors separated by commas")
+        parser.add_argument("values_fields", help="fields with values to correlate separated by commas")
+        parser.add_argument("output", help=".npz file to write the results to")
+        parser.add_argument("-w", "--window", help="window size", default=5, type=int)
+        parser.add_argument("-n", "--permutations", type=int, default=0,
+                            help="number of permutations for a permutation test (default: parametric p-values)")
+        parser.add_argument("-c", "--correction", choices=("max", "fdr", "none"), default="max",
+                            help="multiple comparison correction for the permutation test")
+        parser.add_argument("-s", "--seed", type=int, default=0, help="seed for the permutations")
+        parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+        args = parser.parse_args()
+
+        results = {}
+        factor_matrices = {}
+        factor_ordinals = {}
+        for factors_field in args.factors_fields.split(','):
+            dates, factors_list, factors_mat = self.lists_to_mat(factors_field, 0, len(self.database), verbose=False)
+            factor_matrices[factors_field] = factors_mat
+            factor_ordinals[factors_field] = dates_to_ordinals(dates)
+            results[f"{factors_field}.factors"] = np.array(factors_list)
+            results[f"{factors_field}.counts"] = factors_mat.sum(axis=0)
+
+        # each pair only uses the factor days within the range of its values field
+        pairs = []
+        tasks = []
+        for values_field in args.values_fields.split(','):
+            first_index, last_index = self.field_index_range(values_field)
+            first_ordinal, last_ordinal = self.columns.ordinals[[first_index, last_index - 1]]
+            for factors_field, ordinals in factor_ordinals.items():
+                rows = np.flatnonzero((ordinals >= first_ordinal) & (ordinals <= last_ordinal))
+                values = self.shifted_values(values_field, ordinals[rows], args.window)
+                pairs.append((factors_field, values_field))
+                tasks.append((factors_field, rows, values))
+
+        with stage('statistics'):
+            outputs = correlate_many(factor_matrices, tasks, args.permutations, args.correction, args.seed,
+                                     args.jobs)
+        for (factors_field, values_field), (corr, p) in zip(pairs, outputs):
+            results[f"{factors_field}.{values_field}.corr"] = corr
+            results[f"{factors_field}.{values_field}.p"] = p
+            print(f"{factors_field} x {values_field}: {np.sum(p < 0.05)} cells with p < 0.05")
+
+        np.savez(args.output, **results)
+
+    @timed
+    def render(self):
+        """Renders many plots, histograms and correlations to image files without opening any
+        window. Each line of the specs file holds the output file, the command and its
+        arguments as they would be given on the command line, for example
+        "sat.png plot sat,fz 365 -a 7". The database is loaded once and the figures are drawn
+        in parallel by worker processes. Commands with workers of their own then use one
+        unless their arguments give -j.
+        """
+        global _calendar
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument("specs", help="file with one output file, command and arguments per line")
+        parser.add_argument("-o", "--output-dir", default=".", help="folder for relative output files")
+        parser.add_argument("--dpi", type=int, default=150, help="resolution of raster images")
+        parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+        args = parser.parse_args()
+
+        specs = []
+        with open(args.specs, 'r', encoding='utf-8') as f:
+            for line in f:
+                words = shlex.split(line, comments=True)
+                if words:
+                    if len(words) < 2:
+                        parser.error(f"missing command after {words[0]}, expecting one of {', '.join(render_commands)}")
+                    if words[1] not in render_commands:
+                        parser.error(f"unknown command {words[1]}, expecting one of {', '.join(render_commands)}")
+                    specs.append((os.path.join(args.output_dir, words[0]), words[1], words[2:], args.dpi))
+
+        import matplotlib
+        matplotlib.use('Agg')
+        _calendar = self
+        if args.jobs > 1 and len(specs) > 1:
+            # a later -j in the arguments of a spec takes precedence
+            specs = [(output, command, ['-j', '1'] + argv if command in parallel_commands else argv, dpi)
+                     for output, command, argv, dpi in specs]
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(args.jobs, initializer=_init_render) as executor:
+                outputs = executor.map(_render_spec, specs)
+                for output in outputs:
+                    print(output)
+        else:
+            for spec in specs:
+                print(_render_spec(spec))
 
     def by_date(self):
         pass
 
+
+# commands that can be rendered in batch
+render_commands = ('plot', 'histogram', 'correlate', 'plot_aligned')
+# commands that start worker processes of their own, as many as CPUs unless told otherwise
+parallel_commands = ('correlate', 'plot_aligned')
+# calendar used by the render workers, inherited from the parent process where possible
+_calendar = None
+
+
+def _init_render():
+    global _calendar
+    import matplotlib
+    matplotlib.use('Agg')
+    if _calendar is None:
+        _calendar = Calendar()
+
+
+def _render_spec(spec):
+    """Draws one figure of a render specs file and saves it.
+    """
+    import matplotlib.pyplot as plt
+
+    output, command, argv, dpi = spec
+    figure = getattr(_calendar, command)(argv=argv, show=False)
+    with stage('save figure'):
+        figure.savefig(output, dpi=dpi)
+    plt.close(figure)
+    return output
@@ -0,0 +1,107 @@
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from storage import write_atomic
+
+
+class QueryCache:
+    def __init__(self, version, max_entries=64, directory=None, max_files=256):
+        """Least recently used cache of the (dates, values) results of get_values, keyed by
+        complex field and index range. Results are only valid for one version of the
+        database, after a change invalidate must be called with the new version. If a
+        directory is given, results are also kept there as npz files named after the
+        version, so that they survive between runs as long as the database does not change.
+        """
+        self.version = version
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _digest(*parts):
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+    def _file(self, key):
+        return os.path.join(self.directory, f'{self._digest(self.version)}-{self._digest(*key)}.npz')
+
+    def get(self, key):
+        """Returns the cached result for key, or None.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+
+        if self.directory is not None:
+            file_path = self._file(key)
+            try:
+                with np.load(file_path) as data:
+                    result = self._store(key, data['dates'], data['values'])
+                # refresh the modification time, files are evicted by it
+                os.utime(file_path)
+                self.hits += 1
+                return result
+            except (OSError, KeyError, ValueError):
+                pass
+
+        self.misses += 1
+        return None
+
+    def put(self, key, dates, values):
+        """Caches a result and returns it with its arrays made read-only, since they are
+        shared by every caller that asks for the same key.
+        """
+        result = self._store(key, dates, values)
+        if self.directory is not None:
+            write_atomic(self._file(key), lambda f: np.savez(f, dates=dates, values=values), binary=True)
+            self._prune(self.max_files)
+        return result
+
+    def _store(self, key, dates, values):
+        dates, values = np.array(dates), np.array(values)
+        dates.flags.writeable = False
+        values.flags.writeable = False
+        self.entries[key] = dates, values
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return dates, values
+
+    def _prune(self, max_files):
+        """Removes the files of other versions and the least recently used ones beyond
+        max_files.
+        """
+        prefix = self._digest(self.version) + '-'
+        files = []
+        for name in os.listdir(self.directory):
+            file_path = os.path.join(self.directory, name)
+            # files being written by write_atomic start with a dot
+            if name.startswith('.'):
+                continue
+            try:
+                if not name.startswith(prefix):
+                    os.remove(file_path)
+                elif name.endswith('.npz'):
+                    files.append((os.stat(file_path).st_mtime_ns, file_path))
+            except OSError:
+                pass
+        files.sort()
+        for _, file_path in files[:max(len(files) - max_files, 0)]:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    def invalidate(self, version):
+        """Drops every result computed for an older version of the database.
+        """
+        self.version = version
+        self.entries.clear()
+        if self.directory is not None:
+            self._prune(self.max_files)
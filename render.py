@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+
+from my_calendar import Calendar
+from timings import enable_from_argv
+
+
+if __name__ == '__main__':
+    enable_from_argv()
+    calendar = Calendar()
+    calendar.render()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from columns import dates_to_ordinals
+from storage import cache_path, stamp, write_atomic
+
+
+# format of the utc_time column of Last.fm exports, for example "31 Jan 2021, 18:02"
+time_format = '%d %b %Y, %H:%M'
+
+
+class Scrobbles:
+    def __init__(self, ordinals, codes, artists, last_time, last_count, csv_stamp):
+        """Scrobbles sorted by time, stored as the day ordinal of each scrobble and the code of
+        its artist in the artists array. last_time is the time of the latest scrobble in
+        seconds since the epoch, last_count the number of scrobbles at that time, and
+        csv_stamp identifies the state of the CSV file they were read from.
+        """
+        self.ordinals = ordinals
+        self.codes = codes
+        self.artists = artists
+        self.last_time = last_time
+        self.last_count = last_count
+        self.csv_stamp = csv_stamp
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=str),
+                   np.iinfo(np.int64).min, 0, '')
+
+    @classmethod
+    def load(cls, path):
+        """Loads the cache from path, returns None if it is missing or unreadable.
+        """
+        try:
+            with np.load(path) as data:
+                return cls(data['ordinals'], data['codes'], data['artists'], int(data['last_time']),
+                           int(data['last_count']), str(data['csv_stamp']))
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, path):
+        arrays = {'ordinals': self.ordinals, 'codes': self.codes, 'artists': self.artists,
+                  'last_time': np.array(self.last_time), 'last_count': np.array(self.last_count),
+                  'csv_stamp': np.array(self.csv_stamp)}
+        write_atomic(path, lambda f: np.savez(f, **arrays), binary=True)
+
+    def append(self, times, artists):
+        """Adds scrobbles given as an array of datetime64 times and an array of artist names.
+        """
+        order = np.argsort(times, kind='stable')
+        times, artists = times[order], artists[order]
+        artist_codes, new_artists = pd.factorize(artists)
+        vocabulary = {artist: code for code, artist in enumerate(self.artists.tolist())}
+        mapping = np.array([vocabulary.setdefault(artist, len(vocabulary)) for artist in new_artists],
+                           dtype=np.int32)
+        self.artists = np.array(list(vocabulary), dtype=str)
+        self.codes = np.concatenate((self.codes, mapping[artist_codes]))
+        self.ordinals = np.concatenate((self.ordinals, dates_to_ordinals(times).astype(np.int32)))
+        if len(times):
+            last_time = int(times[-1].astype('datetime64[s]').astype(np.int64))
+            last_count = int(np.count_nonzero(times == times[-1]))
+            self.last_count = last_count + (self.last_count if last_time == self.last_time else 0)
+            self.last_time = last_time
+
+    def since(self, ordinal):
+        """Returns the scrobbles from the day ordinal on.
+        """
+        start = np.searchsorted(self.ordinals, ordinal)
+        return Scrobbles(self.ordinals[start:], self.codes[start:], self.artists, self.last_time, self.last_count,
+                         self.csv_stamp)
+
+    def top_artists(self, num_artists):
+        """Returns the num_artists artists with most scrobbles, and the code of each scrobble's
+        artist among them, -1 for the other artists.
+        """
+        counts = np.bincount(self.codes, minlength=len(self.artists))
+        top = np.argsort(-counts, kind='stable')[:num_artists]
+        ranks = np.full(len(self.artists), -1, dtype=np.int64)
+        ranks[top] = np.arange(len(top))
+        return self.artists[top].tolist(), ranks[self.codes]
+
+
+def parse_times(strings):
+    """Parses the times with the format of Last.fm exports, falling back to guessing the
+    format of each of them.
+    """
+    try:
+        return pd.to_datetime(strings, format=time_format)
+    except ValueError:
+        return pd.to_datetime(strings, format='mixed')
+
+
+def read_chunks(csv_path, chunk_size, last_time):
+    """Reads the times and artists of the scrobbles from last_time on from the CSV in chunks,
+    together with whether the chunk lists the latest scrobbles first, as Last.fm exports do.
+    Reading then stops at the first chunk that reaches older ones.
+    """
+    for chunk in pd.read_csv(csv_path, usecols=['utc_time', 'artist'], dtype={'utc_time': str, 'artist': str},
+                             keep_default_na=False, chunksize=chunk_size):
+        times = parse_times(chunk['utc_time']).to_numpy().astype('datetime64[s]')
+        new = times.astype(np.int64) >= last_time
+        descending = len(times) < 2 or times[0] >= times[-1]
+        yield times[new], chunk['artist'].to_numpy()[new], descending
+        if descending and (times.astype(np.int64) < last_time).any():
+            break
+
+
+def load_scrobbles(csv_path, chunk_size=200000):
+    """Returns the scrobbles of a Last.fm CSV export, kept in a columnar cache that is only
+    extended with the scrobbles added since the last run. If the file shrank, the cache is
+    rebuilt from scratch. Of the scrobbles within the same minute as the latest cached one,
+    as many as were cached are skipped, the oldest ones in the order of the file.
+    """
+    path = cache_path(csv_path, '.scrobbles.npz')
+    csv_stamp = stamp(csv_path)
+    scrobbles = Scrobbles.load(path)
+    if scrobbles is not None and scrobbles.csv_stamp == csv_stamp:
+        return scrobbles
+    if scrobbles is None or os.path.getsize(csv_path) < int(scrobbles.csv_stamp.split('-')[0]):
+        scrobbles = Scrobbles.empty()
+
+    chunks = list(read_chunks(csv_path, chunk_size, scrobbles.last_time))
+    if chunks:
+        times = np.concatenate([times for times, _, _ in chunks])
+        artists = np.concatenate([artists for _, artists, _ in chunks])
+        at_last_time = np.flatnonzero(times.astype(np.int64) == scrobbles.last_time)
+        num_cached = min(scrobbles.last_count, len(at_last_time))
+        cached = at_last_time[len(at_last_time) - num_cached:] if chunks[0][2] else at_last_time[:num_cached]
+        new = np.ones(len(times), dtype=bool)
+        new[cached] = False
+        scrobbles.append(times[new], artists[new])
+    scrobbles.csv_stamp = csv_stamp
+    scrobbles.save(path)
+    return scrobbles
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="update the cache of a Last.fm scrobbles export")
+    parser.add_argument("csv", help="scrobbles CSV file")
+    parser.add_argument("-c", "--chunk-size", type=int, default=200000, help="rows read at a time")
+    args = parser.parse_args()
+    scrobbles = load_scrobbles(args.csv, args.chunk_size)
+    print(f"{len(scrobbles.ordinals)} scrobbles of {len(scrobbles.artists)} artists")
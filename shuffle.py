@@ -0,0 +1,135 @@
+import numpy as np
+
+
+class HistogramSketch:
+    def __init__(self, lower_bounds, upper_bounds, num_bins=2048, integer=True):
+        """Mergeable sketch of the distributions of several variables, each with num_bins bins
+        of equal width between its bounds, so the memory does not depend on the number of
+        values added. For integer variables, such as sums of counts, the widths are whole
+        numbers and the quantiles are exact whenever the range is below num_bins. NaN values
+        are left out.
+        """
+        self.num_bins = num_bins
+        self.integer = integer
+        self.lower_bounds = np.asarray(lower_bounds, dtype=float)
+        spans = np.asarray(upper_bounds, dtype=float) - self.lower_bounds
+        if integer:
+            self.widths = np.maximum(np.ceil((spans + 1) / num_bins), 1)
+        else:
+            self.widths = np.where(spans > 0, spans / num_bins, 1)
+        self.counts = np.zeros((len(self.widths), num_bins), dtype=np.int64)
+
+    def add(self, values):
+        """Adds a batch of samples x variables.
+        """
+        valid = ~np.isnan(values)
+        bins = np.clip(np.floor((np.where(valid, values, 0) - self.lower_bounds) / self.widths), 0, self.num_bins - 1)
+        flat = bins.astype(np.int64) + np.arange(len(self.widths)) * self.num_bins
+        self.counts += np.bincount(flat[valid], minlength=self.counts.size).reshape(self.counts.shape)
+
+    def merge(self, other):
+        self.counts += other.counts
+
+    def percentiles(self, q):
+        """Returns the percentiles q of each variable as a len(q) x variables array, with the
+        same linear interpolation between order statistics as np.percentile. Within bins
+        wider than one integer, values are taken to be evenly spread.
+        """
+        cumulative = np.cumsum(self.counts, axis=1)
+        num_values = cumulative[:, -1]
+        ranks = np.asarray(q, dtype=float)[:, np.newaxis] / 100 * (num_values - 1)
+
+        def order_statistic(index):
+            rows = np.arange(len(self.widths))
+            bins = np.array([np.searchsorted(row, row_indices, side='right')
+                             for row, row_indices in zip(cumulative, index.T)]).T
+            bins = np.minimum(bins, self.num_bins - 1)
+            before = np.where(bins > 0, cumulative[rows, np.maximum(bins - 1, 0)], 0)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                inside = (index - before + 0.5) / self.counts[rows, bins]
+            if self.integer:
+                positions = np.where(self.widths > 1, (bins + inside) * self.widths - 0.5, bins)
+            else:
+                positions = (bins + inside) * self.widths
+            return self.lower_bounds + positions
+
+        lower = np.floor(ranks)
+        upper = np.minimum(lower + 1, num_values - 1)
+        lower_values = order_statistic(lower)
+        with np.errstate(invalid='ignore'):
+            values = lower_values + (ranks - lower) * (order_statistic(upper) - lower_values)
+        return np.where(num_values > 0, values, np.nan)
+
+
+_shared = {}
+
+
+def _init_worker(values, valid, event_days, side, statistic, bounds, num_bins, integer, batch_size):
+    _shared.update(values=values, valid=valid, event_days=event_days, side=side, statistic=statistic,
+                   bounds=bounds, num_bins=num_bins, integer=integer, batch_size=batch_size)
+
+
+def _shuffle_chunk(seed, num_shuffles):
+    """Computes the statistic of the values over num_shuffles sets of randomly shifted events,
+    in batches where each set becomes a row of a shuffles x days matrix of event occurrences
+    multiplied by the values. Returns the sketch of the results.
+    """
+    values, valid, event_days, side = _shared['values'], _shared['valid'], _shared['event_days'], _shared['side']
+    batch_size = _shared['batch_size']
+    num_days = len(values)
+    sketch = HistogramSketch(*_shared['bounds'], _shared['num_bins'], _shared['integer'])
+
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_shuffles, batch_size):
+        size = min(batch_size, num_shuffles - start)
+        days = event_days + rng.integers(-side, side, size=(size, len(event_days)))
+        flat = days + np.arange(size)[:, np.newaxis] * num_days
+        occurrences = np.bincount(flat.ravel(), minlength=size * num_days).reshape(size, num_days)
+        sums = occurrences @ values
+        if _shared['statistic'] == 'mean':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sums = sums / (occurrences @ valid)
+        sketch.add(sums)
+    return sketch
+
+
+def shuffle_percentiles(values, event_days, side, num_shuffles, q, seed=0, num_workers=1, statistic='sum',
+                        chunk_size=2000, batch_size=256, num_bins=2048):
+    """Null distribution of the sum or the mean (statistic) of a matrix of days x variables
+    over the event days, when each event is shifted by a random number of days in
+    [-side, side). NaN values are left out. The events must be at least side days away from
+    the ends of the matrix. The shuffles are split in chunks of chunk_size, each with its
+    own seed spawned from seed, so results do not depend on the number of worker
+    processes. Their results are collected in histogram sketches that are merged at the
+    end. Returns the percentiles q of each variable as a len(q) x variables array.
+    """
+    values = np.asarray(values, dtype=float)
+    valid = (~np.isnan(values)).astype(float)
+    filled = np.nan_to_num(values)
+    event_days = np.asarray(event_days, dtype=np.int64)
+
+    # bounds of the statistic, from the extremes of the windows around the events, where the sums
+    # count NaN as 0 like the shuffles do
+    with np.errstate(all='ignore'):
+        if statistic == 'sum':
+            windows = np.lib.stride_tricks.sliding_window_view(filled, 2 * side, axis=0)[event_days - side]
+            bounds = windows.min(axis=-1).sum(axis=0), windows.max(axis=-1).sum(axis=0)
+        else:
+            bounds = np.nan_to_num(np.nanmin(values, axis=0)), np.nan_to_num(np.nanmax(values, axis=0))
+    integer = statistic == 'sum' and np.array_equal(filled, np.round(filled))
+    arrays = (filled, valid, event_days, side, statistic, bounds, num_bins, integer, batch_size)
+
+    sizes = [min(chunk_size, num_shuffles - start) for start in range(0, num_shuffles, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    sketch = HistogramSketch(*bounds, num_bins, integer)
+    if num_workers > 1 and len(sizes) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=arrays) as executor:
+            for chunk_sketch in executor.map(_shuffle_chunk, seeds, sizes):
+                sketch.merge(chunk_sketch)
+    else:
+        _init_worker(*arrays)
+        for chunk_seed, size in zip(seeds, sizes):
+            sketch.merge(_shuffle_chunk(chunk_seed, size))
+        _shared.clear()
+    return sketch.percentiles(q)
@@ -0,0 +1,357 @@
+import os
+import json
+import mmap
+import stat
+import tempfile
+import numpy as np
+from columns import OTHER, STR, TextColumn, decode_value, encode_value, ordinals_to_dates, parse_ordinals
+
+
+def write_atomic(path, write, binary=False):
+    """Calls write(f) on a temporary file next to path and renames it over path once it is
+    complete, so that an interrupted write never leaves a truncated file behind.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        # mkstemp creates files readable only by the owner, keep the permissions of the old file
+        mode = stat.S_IMODE(os.stat(path).st_mode) if os.path.exists(path) else 0o644
+        os.chmod(tmp_path, mode)
+        with os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def cache_path(path, suffix):
+    """Path of a file derived from the database, kept in the user cache folder rather than next
+    to the database so that it is not synced with it.
+    """
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'calendar')
+    os.makedirs(cache_dir, exist_ok=True)
+    name = os.path.abspath(path).strip(os.sep).replace(os.sep, '_').replace(':', '')
+    return os.path.join(cache_dir, name + suffix)
+
+
+def stamp(*paths):
+    """Identifies the current state of some files by their sizes and modification times.
+    """
+    parts = []
+    for file_path in paths:
+        try:
+            info = os.stat(file_path)
+            parts.append(f'{info.st_size}-{info.st_mtime_ns}')
+        except FileNotFoundError:
+            parts.append('none')
+    return ' '.join(parts)
+
+
+def is_binary(path):
+    return path.endswith('.bin')
+
+
+def read_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_json(path, database):
+    write_atomic(path, lambda f: json.dump(list(database), f, indent=4, separators=(',', ': '), ensure_ascii=False))
+
+
+def read_database(path):
+    """Opens the database, lazily if it is stored in the binary format.
+    """
+    if is_binary(path):
+        return LazyDatabase(BinaryStore(path))
+    return read_json(path)
+
+
+def write_database(path, database):
+    if is_binary(path):
+        write_binary(path, database)
+    else:
+        write_json(path, database)
+
+
+class Journal:
+    def __init__(self, path):
+        """Write-ahead journal with one JSON record per line. Each record stores the full
+        contents of a day together with its index in the database, so replaying a record
+        is idempotent. Records are matched to the days by date, the index is only a hint,
+        so that days inserted or deleted by hand in the database file do not shift them.
+        """
+        self.path = path
+        self.num_entries = 0
+
+    def replay(self, database):
+        """Applies the journal records to the database in place and returns the indices of
+        the days that were touched. Records of dates after the last day are appended.
+        Raises ValueError, without changing the database, if a record belongs to a date
+        that is missing from the database and is not after its last day. Truncated lines,
+        left by interrupted appends, are skipped.
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            lines = []
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+        # find the day of every record before changing anything
+        length = len(database)
+        last_date = database[length - 1]['date'] if length else ''
+        date_indices = None
+        placed = []
+        for record in records:
+            day_date = record['day']['date']
+            index = record['index']
+            if not (index < len(database) and database[index]['date'] == day_date):
+                if date_indices is None:
+                    date_indices = {day['date']: day_index for day_index, day in enumerate(database)}
+                if day_date in date_indices:
+                    index = date_indices[day_date]
+                elif day_date > last_date:
+                    index = date_indices[day_date] = length
+                    last_date = day_date
+                    length += 1
+                else:
+                    raise ValueError(f'{self.path} has a record of {day_date}, which is missing from the database '
+                                     f'and is not after its last day')
+            placed.append((index, record['day']))
+
+        touched = []
+        for index, day in placed:
+            if index < len(database):
+                database[index] = day
+            else:
+                database.append(day)
+            touched.append(index)
+        self.num_entries = len(placed)
+        return touched
+
+    def append(self, database, indices):
+        """Appends the current contents of the days at the given indices.
+        """
+        with open(self.path, 'a+b') as f:
+            # terminate a line left truncated by an interrupted append
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+            for index in indices:
+                record = {'index': index, 'day': database[index]}
+                f.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        self.num_entries += len(indices)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.num_entries = 0
+
+
+MAGIC = b'CALCOLS1'
+ALIGNMENT = 8
+
+
+class BinaryStore:
+    def __init__(self, path):
+        """Memory-mapped columnar database file. The file starts with MAGIC, the length of a
+        JSON header and the header itself, followed by 8-byte aligned blocks: the day
+        ordinals, the key order of each day, and for every field an array of kinds, the
+        numbers as codes into a table of distinct values and, if the field holds strings,
+        their offsets and the text heap holding them. Nothing is decoded until it is
+        requested.
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a binary calendar file')
+        header_length = int.from_bytes(self.mm[len(MAGIC):len(MAGIC) + 8], 'little')
+        start = len(MAGIC) + 8
+        self.header = json.loads(self.mm[start:start + header_length].decode('utf-8'))
+        self.data_start = aligned(start + header_length)
+        self.num_days = self.header['num_days']
+        self.layouts = self.header['layouts']
+        self._columns = {}
+
+    def _array(self, block):
+        offset, count, dtype = block
+        return np.frombuffer(self.mm, dtype=dtype, count=count, offset=self.data_start + offset)
+
+    def ordinals(self):
+        return self._array(self.header['ordinals'])
+
+    def layout_codes(self):
+        return self._array(self.header['layout_codes'])
+
+    def other(self, field, index):
+        """Returns a value of kind OTHER, stored as JSON in the header.
+        """
+        return self.header['fields'][field]['other'][str(index)]
+
+    def column(self, field):
+        """Returns the kinds, numbers and TextColumn of a field.
+        """
+        if field not in self._columns:
+            if field in self.header['fields']:
+                blocks = self.header['fields'][field]
+                kinds = self._array(blocks['kinds'])
+                numbers = self._array(blocks['values'])[self._array(blocks['codes'])]
+                if 'heap' in blocks:
+                    offsets = self._array(blocks['offsets']).astype(np.int64) + self.data_start + blocks['heap'][0]
+                    text = TextColumn.from_pool(self.mm, offsets, kinds == STR)
+                else:
+                    text = TextColumn([None] * self.num_days)
+            else:
+                kinds = np.zeros(self.num_days, dtype=np.uint8)
+                numbers = np.full(self.num_days, np.nan)
+                text = TextColumn([None] * self.num_days)
+            self._columns[field] = kinds, numbers, text
+        return self._columns[field]
+
+    def day(self, index):
+        """Decodes the dictionary of one day.
+        """
+        day = {}
+        for key in self.layouts[self.layout_codes()[index]]:
+            if key == 'date':
+                day[key] = str(ordinals_to_dates(self.ordinals()[index]))
+                continue
+            kinds, numbers, text = self.column(key)
+            kind = int(kinds[index])
+            if kind == OTHER:
+                day[key] = self.other(key, index)
+            else:
+                day[key] = decode_value(kind, numbers[index], text[index])
+        return day
+
+
+class LazyDatabase:
+    def __init__(self, store):
+        """List-like view of a BinaryStore that decodes days only when they are accessed.
+        Days that are assigned or appended are kept in changes, indexed by position.
+        """
+        self.store = store
+        self.changes = {}
+        self.cache = {}
+        self.length = store.num_days
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('database index out of range')
+        if index in self.changes:
+            return self.changes[index]
+        if index not in self.cache:
+            self.cache[index] = self.store.day(index)
+        return self.cache[index]
+
+    def __setitem__(self, index, day):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('database assignment index out of range')
+        self.changes[index] = day
+
+    def __iter__(self):
+        for index in range(self.length):
+            yield self[index]
+
+    def append(self, day):
+        self.changes[self.length] = day
+        self.length += 1
+
+
+def write_binary(path, database):
+    """Writes the database in the format read by BinaryStore.
+    """
+    num_days = len(database)
+    layouts = {}
+    layout_codes = np.empty(num_days, dtype=np.int64)
+    field_names = {}
+    for index, day in enumerate(database):
+        layout = tuple(day)
+        layout_codes[index] = layouts.setdefault(layout, len(layouts))
+        for key in layout:
+            if key != 'date':
+                field_names.setdefault(key, None)
+
+    header = {'num_days': num_days, 'layouts': [list(layout) for layout in layouts], 'fields': {}}
+    blocks = [('ordinals', None, parse_ordinals([day['date'] for day in database])),
+              ('layout_codes', None, smallest_unsigned(layout_codes))]
+    for field in field_names:
+        kinds = np.zeros(num_days, dtype=np.uint8)
+        numbers = np.full(num_days, np.nan)
+        texts = []
+        other = {}
+        for index, day in enumerate(database):
+            if field in day:
+                kinds[index], numbers[index], text = encode_value(day[field])
+                if kinds[index] == OTHER:
+                    other[str(index)] = day[field]
+            else:
+                text = None
+            texts.append(text)
+        header['fields'][field] = {'other': other}
+        values, codes = np.unique(numbers, return_inverse=True)
+        blocks += [(field, 'kinds', kinds), (field, 'values', values), (field, 'codes', smallest_unsigned(codes))]
+        if (kinds == STR).any():
+            text = TextColumn(texts)
+            blocks += [(field, 'offsets', smallest_unsigned(text.offsets)),
+                       (field, 'heap', np.frombuffer(text.pool, dtype=np.uint8))]
+
+    # block positions are relative to the start of the data, which follows the header
+    position = 0
+    for name, part, array in blocks:
+        entry = [position, len(array), array.dtype.str]
+        if part is None:
+            header[name] = entry
+        else:
+            header['fields'][name][part] = entry
+        position = aligned(position + array.nbytes)
+    encoded_header = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    def write(f):
+        f.write(MAGIC)
+        f.write(len(encoded_header).to_bytes(8, 'little'))
+        f.write(encoded_header)
+        for name, part, array in blocks:
+            f.write(b'\x00' * (aligned(f.tell()) - f.tell()))
+            f.write(array.tobytes())
+
+    write_atomic(path, write, binary=True)
+
+
+def aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def smallest_unsigned(array):
+    """Casts an array of non-negative integers to the smallest unsigned type that holds it.
+    """
+    maximum = array.max() if len(array) else 0
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if maximum <= np.iinfo(dtype).max:
+            return array.astype(dtype)
+    return array.astype(np.uint64)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import argparse
+import numpy as np
+from datetime import date, timedelta
+from config import fields
+from storage import write_database
+
+
+words = ("woke up early went to the office worked from home long meeting walked in the park "
+         "read a book cooked dinner with friends slept badly tired headache sunny rainy cold "
+         "call with family cinema at night").split()
+foods = ("pan queso vino cerveza cafe te chocolate tomate arroz pasta pescado pollo ternera "
+         "huevos leche yogur naranja platano manzana fresas lentejas garbanzos patatas "
+         "aguacate nueces").split()
+
+
+def generate(num_days, seed=0, first_date='2000-01-01', list_fields=('food',), pain_probability=0.1):
+    """Creates a synthetic database of num_days following the schema in config.fields. Numbers
+    are drawn within their range, text fields get random sentences with the keyword of each
+    implicit field appearing in some of them, the fields in list_fields get comma-separated
+    lists of foods, and implicit fields are filled by matching their keyword. Active fields are
+    present in most days and inactive ones in about half of them, and a few days are skipped.
+    """
+    rng = np.random.default_rng(seed)
+    all_fields = {**fields['active'], **fields['inactive']}
+    presence = {name: 0.9 if name in fields['active'] else 0.5 for name in all_fields}
+    keywords = {}
+    for specs in all_fields.values():
+        if 'match' in specs:
+            keywords.setdefault(specs['in'], []).append(specs['match'])
+
+    database = []
+    current_date = date.fromisoformat(first_date)
+    for _ in range(num_days):
+        day = {'date': str(current_date)}
+        for name, specs in all_fields.items():
+            if 'in' in specs or rng.random() > presence[name]:
+                continue
+            if specs['type'] is str:
+                if name in list_fields:
+                    items = rng.choice(len(foods), size=rng.integers(1, 7), replace=False)
+                    day[name] = ', '.join(foods[item] for item in items)
+                else:
+                    sentence = [words[word] for word in rng.integers(0, len(words), rng.integers(3, 30))]
+                    for keyword in keywords.get(name, []):
+                        if rng.random() < pain_probability:
+                            sentence.insert(rng.integers(0, len(sentence) + 1), keyword)
+                    day[name] = ' '.join(sentence)
+            elif specs['type'] is bool:
+                day[name] = bool(rng.random() < 0.5)
+            else:
+                minimum, maximum = specs.get('range', (0, 10))
+                if specs['type'] is int:
+                    day[name] = int(rng.integers(minimum, maximum + 1))
+                else:
+                    day[name] = round(float(rng.uniform(minimum, maximum)), 1)
+        for name, specs in all_fields.items():
+            if 'match' in specs:
+                day[name] = specs['in'] in day and specs['match'] in day[specs['in']]
+        database.append(day)
+        current_date += timedelta(days=1 if rng.random() > 0.02 else int(rng.integers(2, 5)))
+    return database
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="write a synthetic calendar following the configured fields")
+    parser.add_argument("num_days", type=int, help="number of days")
+    parser.add_argument("output", help="output file, binary if it ends in .bin")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-d", "--date", default='2000-01-01', help="first date")
+    args = parser.parse_args()
+    write_database(args.output, generate(args.num_days, args.seed, args.date))
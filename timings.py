@@ -0,0 +1,138 @@
+import sys
+import time
+import atexit
+import functools
+import tracemalloc
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# stages are only measured after enable is called, usually from the command line flags
+enabled = False
+# tracing the allocations slows all of them down, so the peak of each stage is only measured on request
+trace_memory = False
+# (name, depth, seconds, peak resident bytes, peak allocated bytes) of every stage, in the order in
+# which they started
+records = []
+# peak memory allocated so far by the whole program and by each of the open stages, innermost last
+_peaks = [0]
+
+
+def max_rss():
+    """Returns the peak resident set size of the process so far in bytes, or None where the
+    platform does not report it.
+    """
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+@contextmanager
+def stage(name):
+    """Measures the wall time while the block runs and the peak resident set size of the
+    process when it ends. With trace_memory, also the peak of the memory allocated by python
+    and numpy while the block runs. Stages can be nested.
+    """
+    if not enabled:
+        yield
+        return
+
+    if trace_memory:
+        # the peak is reset for the new stage, keep the one reached so far by the enclosing one
+        _peaks[-1] = max(_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    _peaks.append(0)
+    record = [name, len(_peaks) - 2, 0., None, None]
+    records.append(record)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record[2] = time.perf_counter() - start
+        record[3] = max_rss()
+        peak = _peaks.pop()
+        if trace_memory:
+            record[4] = max(peak, tracemalloc.get_traced_memory()[1])
+            _peaks[-1] = max(_peaks[-1], record[4])
+
+
+def timed(method):
+    """Decorator that runs a whole method as a stage named after it.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with stage(method.__name__):
+            return method(*args, **kwargs)
+    return wrapper
+
+
+def enable(profile_path=None, memory=False):
+    """Starts measuring stages, and profiling with cProfile if a path for its statistics is
+    given. With memory, the allocations are traced to find the peak of each stage, which
+    makes the times longer. The report is printed to stderr when the program exits.
+    """
+    global enabled, trace_memory
+    enabled = True
+    trace_memory = memory
+    if memory:
+        tracemalloc.start()
+    profiler = None
+    if profile_path is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(report, profiler, profile_path)
+
+
+def enable_from_argv(argv=None):
+    """Removes the --timings, --memory and --profile[=FILE] flags from argv (sys.argv by
+    default) so that the scripts do not see them, and enables the measurements they ask for.
+    --memory adds the peak allocations of each stage to the timings. --profile also writes
+    the cProfile statistics, to FILE or to the name of the script followed by .prof.
+    """
+    argv = sys.argv if argv is None else argv
+    timings = False
+    memory = False
+    profile_path = None
+    for arg in list(argv[1:]):
+        if arg == '--timings':
+            timings = True
+        elif arg == '--memory':
+            memory = True
+        elif arg == '--profile' or arg.startswith('--profile='):
+            profile_path = arg.partition('=')[2] or argv[0].rsplit('.', 1)[0] + '.prof'
+        else:
+            continue
+        argv.remove(arg)
+    if timings or memory or profile_path is not None:
+        enable(profile_path, memory)
+
+
+def _megabytes(num_bytes):
+    return '-' if num_bytes is None else f'{num_bytes / 2 ** 20:.1f}'
+
+
+def report(profiler=None, profile_path=None):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    header = f"\n{'stage':<32} {'time (ms)':>12} {'max resident (MB)':>18}"
+    if trace_memory:
+        header += f" {'peak allocated (MB)':>20}"
+    print(header, file=sys.stderr)
+    for name, depth, seconds, rss, peak in records:
+        line = f"{'  ' * depth + name:<32} {seconds * 1000:12.1f} {_megabytes(rss):>18}"
+        if trace_memory:
+            line += f" {_megabytes(peak):>20}"
+        print(line, file=sys.stderr)
+    total = f"{'total':<32} {'':12} {_megabytes(max_rss()):>18}"
+    if trace_memory:
+        total += f" {_megabytes(max(_peaks[0], tracemalloc.get_traced_memory()[1])):>20}"
+        total += "\ntimes include the overhead of tracing the allocations, run without --memory for accurate ones"
+    print(total, file=sys.stderr)
+    if profiler is not None:
+        print(f"profile written to {profile_path}", file=sys.stderr)